@@ -4,23 +4,833 @@ Provides the majority of the logic in the charm, specifically all logic which
 can be meaningfully unit tested.
 """
 try:
-    from urllib.parse import urlparse
+    from urllib.parse import quote, urlparse
 except ImportError:
+    from urllib import quote
     from urlparse import urlparse
 
+import functools
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import shlex
+import shutil
 import socket
 import subprocess
+import tarfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 
 from charmhelpers.core import hookenv, host, templating, unitdata
 from charmhelpers.fetch import apt_install, apt_update, add_source, ubuntu_apt_pkg
 
 from charms.reactive.flags import _get_flag_value
-from charms.reactive.helpers import any_file_changed
 
 from reactive.layer_backup import Backup as BackupHelper
 
 import semantic_version
 
+# GitLab's required upgrade stops, as (major, minor) release series. Upgrades
+# spanning one of these must install the latest patch release of the series
+# before continuing. https://docs.gitlab.com/ee/update/#upgrade-paths
+UPGRADE_STOPS = [
+    (8, 11),
+    (8, 12),
+    (8, 17),
+    (9, 5),
+    (10, 8),
+    (11, 11),
+    (12, 0),
+    (12, 1),
+    (12, 10),
+    (13, 0),
+    (13, 1),
+    (13, 8),
+    (13, 12),
+    (14, 0),
+    (14, 3),
+    (14, 9),
+    (14, 10),
+    (15, 0),
+    (15, 4),
+    (15, 11),
+    (16, 3),
+    (16, 7),
+    (16, 11),
+    (17, 3),
+    (17, 5),
+    (17, 8),
+    (17, 11),
+]
+
+# Seconds per upgrade step assumed by the upgrade planner until real step
+# timings have been recorded on this unit.
+DEFAULT_UPGRADE_STEP_SECONDS = 600
+
+# Memory in MB left for the OS, Gitaly, Sidekiq and other GitLab services when
+# working out how many Puma workers fit on a unit, per GitLab's sizing guidance.
+PUMA_RESERVED_MEMORY_MB = 1536
+# Memory in MB needed by each Puma worker.
+PUMA_WORKER_MEMORY_MB = 1024
+PUMA_THREADS = 4
+# Sidekiq threads per CPU core, and the most threads GitLab recommends per process.
+SIDEKIQ_THREADS_PER_CPU = 5
+SIDEKIQ_MAX_THREADS = 20
+# CPU cores per Sidekiq process when working out how many processes to run.
+SIDEKIQ_CPUS_PER_PROCESS = 4
+
+# Database connections each GitLab process needs beyond one per thread, for
+# the process' own housekeeping.
+DB_POOL_HEADROOM = 2
+# Local address of the bundled PgBouncer.
+PGBOUNCER_HOST = "127.0.0.1"
+PGBOUNCER_PORT = 6432
+
+# Roles which can be given their own Redis instance, each related over a
+# redis-<role> relation. Roles without one use the main redis relation.
+REDIS_ROLES = ["cache", "queues", "shared_state", "actioncable"]
+
+# Object types offloaded to object storage, each to a bucket of its own.
+OBJECT_STORE_TYPES = [
+    "artifacts",
+    "external_diffs",
+    "lfs",
+    "uploads",
+    "packages",
+    "dependency_proxy",
+    "terraform_state",
+    "pages",
+]
+
+# Where omnibus keeps repositories by default, used as the "default" storage.
+DEFAULT_GIT_DATA_DIR = "/var/opt/gitlab/git-data"
+# Weight of each repository storage when placing new projects, unless configured.
+DEFAULT_REPOSITORY_STORAGE_WEIGHT = 100
+
+# Roles a unit can run, each enabling only its own omnibus services.
+ROLES = ["all", "rails", "sidekiq", "gitaly"]
+# Roles running the Puma web server, and those running Sidekiq.
+PUMA_ROLES = ["all", "rails"]
+SIDEKIQ_ROLES = ["all", "sidekiq"]
+# Port Gitaly listens on in the gitaly role.
+GITALY_PORT = 8075
+
+# Parallel compressors a streamed backup can be compressed with, and the archive extension.
+BACKUP_COMPRESSORS = {
+    "pigz": (["pigz", "-c"], "tar.gz"),
+    "zstd": (["zstd", "-T0", "-c"], "tar.zst"),
+}
+# Files and directories gitlab-backup writes to the backup directory for a
+# backup it leaves unarchived.
+BACKUP_ENTRIES = [
+    "backup_information.yml",
+    "db",
+    "repositories",
+    "uploads.tar.gz",
+    "builds.tar.gz",
+    "artifacts.tar.gz",
+    "pages.tar.gz",
+    "lfs.tar.gz",
+    "terraform_state.tar.gz",
+    "registry.tar.gz",
+    "packages.tar.gz",
+    "ci_secure_files.tar.gz",
+    "external_diffs.tar.gz",
+]
+# Size of the chunks a streamed backup is copied to its destination in.
+BACKUP_STREAM_CHUNK = 1024 * 1024
+
+# pgloader rows per batch and rows read ahead per reader, unless given to the migratedb action.
+PGLOADER_BATCH_ROWS = 25000
+PGLOADER_PREFETCH_ROWS = 100000
+
+# Number of timing records kept in the hook profile ring buffer.
+PROFILE_MAX_RECORDS = 2000
+
+_profile_lock = threading.Lock()
+
+
+def profiled(method):
+    """Record the duration of each call to a GitlabHelper method in the hook profile."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.profile(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def get_cpu_count():
+    """Return the number of CPU cores available to this unit."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_total_ram_mb():
+    """Return the total memory of this unit in MB."""
+    return int(host.get_total_ram() / (1024 * 1024))
+
+
+def get_app_unit_count():
+    """Return the number of units this application is expected to have."""
+    try:
+        return max(1, len(hookenv.goal_state().get("units", {})))
+    except (NotImplementedError, OSError, subprocess.CalledProcessError):
+        # goal-state needs Juju 2.4, fall back to the peers joined so far
+        return 1 + sum(len(hookenv.related_units(rid)) for rid in hookenv.relation_ids("cluster"))
+
+
+def get_relation_value(relation_name, key):
+    """Return the first value of a key published by any remote unit on a relation."""
+    for rid in hookenv.relation_ids(relation_name):
+        for unit in hookenv.related_units(rid):
+            value = hookenv.relation_get(key, unit=unit, rid=rid)
+            if value:
+                return value
+    return None
+
+
+def redis_relation_name(role):
+    """Return the name of the relation providing the Redis instance of a role."""
+    return "redis-{}".format(role.replace("_", "-"))
+
+
+def _bracket_depth(text):
+    """Return the bracket nesting depth at the end of a line of Ruby, ignoring string contents."""
+    depth = 0
+    quote = None
+    escaped = False
+    for char in text:
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+    return depth
+
+
+def parse_gitlab_rb(content):
+    """Return the effective settings of a gitlab.rb file as an ordered dict of setting to value.
+
+    Comments, blank lines and formatting are dropped, so two files only
+    compare differently if they would configure GitLab differently. Method
+    style settings such as external_url are keyed by the method name.
+    """
+    settings = OrderedDict()
+    statement = ""
+    depth = 0
+    for line in content.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        statement = "{} {}".format(statement, stripped).strip()
+        depth += _bracket_depth(stripped)
+        if depth > 0:
+            continue
+        setting = re.match(r"^(\w+(?:\[[^\]]*\])*)\s*=\s*(.*)$", statement) or re.match(
+            r"^(\w+)[\s(]*(.*)$", statement
+        )
+        if setting:
+            key, value = setting.groups()
+            settings[key] = " ".join(value.split())
+        statement = ""
+        depth = 0
+    return settings
+
+
+def parse_backup_output(output):
+    """Return the backup ID and the duration in seconds of each component from gitlab-backup output.
+
+    Components which were skipped or are disabled have a duration of None.
+    The backup ID is None if the output doesn't report one.
+    """
+    backup_id = None
+    started = {}
+    durations = OrderedDict()
+    for line in output.splitlines():
+        step = re.match(
+            r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\S* (?:\S+ )?-- (?:Dumping|Restoring) (.+?) \.\.\.\s*(.*)$",
+            line.strip(),
+        )
+        if step:
+            timestamp, component, result = step.groups()
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            component = component.replace(" ", "-")
+            if not result:
+                started[component] = timestamp
+            elif result == "done" and component in started:
+                durations[component] = int((timestamp - started[component]).total_seconds())
+            elif result.startswith("["):
+                durations[component] = None
+            continue
+        done = re.search(r"Backup (\S+) is done", line) or re.search(
+            r"Creating backup archive: (\S+)_gitlab_backup\.tar", line
+        )
+        if done:
+            backup_id = done.group(1)
+    return backup_id, durations
+
+
+def parse_pgloader_duration(duration):
+    """Return the seconds of a pgloader duration such as 12.345s, 2m3.456s or 1h2m3.456s."""
+    units = {"h": 3600, "m": 60, "s": 1}
+    return sum(
+        float(value) * units[unit] for value, unit in re.findall(r"([\d.]+)([hms])", duration)
+    )
+
+
+def parse_pgloader_summary(line):
+    """Return the table, row count and seconds of a table row of pgloader's summary, or None.
+
+    pgloader reports errors, rows and bytes per table. Recent versions
+    report read and imported rows separately, and add read and write times.
+    """
+    row = re.match(
+        r'^\s*("?[\w$]+"?\."?[\w$]+"?)\s+(\d+)\s+(\d+)(?:\s+(\d+))?'
+        r"(?:\s+[\d.]+ [kMGT]?B)?\s+([\d.hms]+)(?:\s+[\d.hms]+)*\s*$",
+        line,
+    )
+    if not row:
+        return None
+    table, _, rows, imported, duration = row.groups()
+    return table.replace('"', ""), int(imported or rows), parse_pgloader_duration(duration)
+
+
+def verify_bundle(bundle):
+    """Return whether a git bundle read from a file object is intact, reading it in bounded chunks.
+
+    The packfile of a bundle ends with the checksum of its contents, in the
+    repository's object format, which is checked without unpacking any
+    object.
+    """
+    header = b""
+    while b"\n\n" not in header:
+        chunk = bundle.read(BACKUP_STREAM_CHUNK)
+        if not chunk:
+            return False
+        header += chunk
+    header, tail = header.split(b"\n\n", 1)
+    if not re.match(br"^# v[23] git bundle\n", header):
+        return False
+    digest = hashlib.sha256() if b"@object-format=sha256" in header else hashlib.sha1()
+    trailer_size = digest.digest_size
+    signature = tail[:4]
+    for chunk in iter(lambda: bundle.read(BACKUP_STREAM_CHUNK), b""):
+        if len(signature) < 4:
+            signature = (signature + chunk)[:4]
+        tail += chunk
+        digest.update(tail[:-trailer_size])
+        tail = tail[-trailer_size:]
+    if len(tail) > trailer_size:
+        digest.update(tail[:-trailer_size])
+        tail = tail[-trailer_size:]
+    return signature == b"PACK" and digest.digest() == tail
+
+
+def verify_gzip(compressed):
+    """Return whether gzip data read from a file object decompresses with a matching CRC."""
+    try:
+        with gzip.GzipFile(fileobj=compressed) as decompressed:
+            for _ in iter(lambda: decompressed.read(BACKUP_STREAM_CHUNK), b""):
+                pass
+    except (OSError, EOFError, zlib.error):
+        return False
+    return True
+
+
+def file_sha256(path):
+    """Return the hex SHA256 digest of a file, read in chunks to bound memory use."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as package_file:
+        for chunk in iter(lambda: package_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GitlabSettings:
+    """The effective settings for GitLab during a single hook or action.
+
+    Gathers charm configuration, relation data saved in the unit KV store
+    and the values derived from them, so that the template and every other
+    consumer read the same values. Derived values which need a DNS lookup or
+    URL parse are worked out once and reused.
+    """
+
+    # KV key prefix and Rails adapter of each supported database, in order of preference
+    database_backends = [("pgsql", "postgresql"), ("mysql", "mysql2"), ("db", "mysql2")]
+
+    def __init__(self, charm_config, kv):
+        """Wrap charm configuration and the unit KV store."""
+        self.charm_config = charm_config
+        self.kv = kv
+        self._fqdn = None
+        self._parsed_url = (None, None)
+        self._cpu_count = None
+        self._total_ram_mb = None
+
+    @property
+    def fqdn(self):
+        """Return the FQDN of this unit, resolved at most once."""
+        if self._fqdn is None:
+            self._fqdn = socket.getfqdn()
+        return self._fqdn
+
+    @property
+    def external_url(self):
+        """Return the configured external URL, defaulting to the FQDN of the unit."""
+        if self.charm_config["external_url"]:
+            return self.charm_config["external_url"]
+        return "http://{}".format(self.fqdn)
+
+    @property
+    def parsed_url(self):
+        """Return the parsed external URL, only parsing again if the URL changes."""
+        url = self.external_url
+        if self._parsed_url[0] != url:
+            self._parsed_url = (url, urlparse(url))
+        return self._parsed_url[1]
+
+    @property
+    def ssh_host(self):
+        """Return the host used when configuring SSH access to GitLab."""
+        return self.parsed_url.hostname or self.fqdn
+
+    @property
+    def ssh_port(self):
+        """Return the SSH port advertised by GitLab, which is the proxy's when one is configured."""
+        if _get_flag_value("reverseproxy.configured"):
+            return self.charm_config["proxy_ssh_port"]
+        return self.charm_config["ssh_port"]
+
+    @property
+    def smtp_enabled(self):
+        """Return True if all configuration is in place for external SMTP usage."""
+        return bool(self.charm_config.get("smtp_server") and self.charm_config.get("smtp_port"))
+
+    @property
+    def smtp_domain(self):
+        """Return the SMTP HELO domain, defaulting to the host of the external URL."""
+        return self.charm_config.get("smtp_domain") or self.ssh_host
+
+    @property
+    def runner_url(self):
+        """Return the URL published to related runners."""
+        if self.charm_config["runners_bypass_proxy"]:
+            return "http://{}".format(self.fqdn)
+        return self.external_url
+
+    @property
+    def role(self):
+        """Return the role of this unit, running everything if an unknown role is configured."""
+        role = self.charm_config.get("role")
+        return role if role in ROLES else "all"
+
+    @property
+    def ports(self):
+        """Return the TCP ports GitLab listens on."""
+        if self.role == "gitaly":
+            return [str(GITALY_PORT)]
+        if self.role == "sidekiq":
+            return []
+        return ["80", str(self.charm_config["ssh_port"])]
+
+    @property
+    def gitaly(self):
+        """Return the settings of the Gitaly server in the gitaly role, or None in other roles.
+
+        Rails units publish the URL Gitaly calls back on and the GitLab
+        Shell secret over the gitaly relation.
+        """
+        if self.role != "gitaly":
+            return None
+        clients = self.kv.get("gitaly_clients") or {}
+        return {
+            "port": GITALY_PORT,
+            "token": hookenv.leader_get("gitaly-token"),
+            "internal_api_url": clients.get("internal_api_url"),
+            "shell_secret": clients.get("shell_secret"),
+        }
+
+    @property
+    def gitaly_storages(self):
+        """Return the address and token of each storage served by related Gitaly units."""
+        if self.role == "gitaly":
+            return OrderedDict()
+        return OrderedDict(self.kv.get("gitaly_servers") or [])
+
+    @property
+    def auto_migrate(self):
+        """Return True if this unit runs database migrations, which only the leader of a Rails application does."""
+        return self.role != "gitaly" and hookenv.is_leader()
+
+    @property
+    def gitlab_shell_secret(self):
+        """Return the GitLab Shell secret shared with Gitaly units, or None without any."""
+        if self.gitaly:
+            return self.gitaly["shell_secret"]
+        if self.gitaly_storages:
+            return hookenv.leader_get("gitlab-shell-secret")
+        return None
+
+    @property
+    def cpu_count(self):
+        """Return the number of CPU cores of this unit, read at most once."""
+        if self._cpu_count is None:
+            self._cpu_count = get_cpu_count()
+        return self._cpu_count
+
+    @property
+    def total_ram_mb(self):
+        """Return the total memory of this unit in MB, read at most once."""
+        if self._total_ram_mb is None:
+            self._total_ram_mb = get_total_ram_mb()
+        return self._total_ram_mb
+
+    @property
+    def puma(self):
+        """Return the Puma worker and thread settings for this unit.
+
+        Per GitLab's sizing guidance, a worker is run per CPU core as long as
+        the memory for it is available after reserving memory for the rest of
+        GitLab, with a minimum of two workers. The per worker memory limit is
+        the unit's spare memory shared between the workers. Non-zero charm
+        configuration values always win over the computed ones.
+        """
+        spare_memory_mb = max(0, self.total_ram_mb - PUMA_RESERVED_MEMORY_MB)
+        workers = self.charm_config.get("puma_workers") or max(
+            2, min(self.cpu_count, spare_memory_mb // PUMA_WORKER_MEMORY_MB)
+        )
+        max_threads = self.charm_config.get("puma_max_threads") or PUMA_THREADS
+        min_threads = min(self.charm_config.get("puma_min_threads") or max_threads, max_threads)
+        max_memory_mb = self.charm_config.get("puma_per_worker_max_memory_mb") or max(
+            PUMA_WORKER_MEMORY_MB, spare_memory_mb // workers
+        )
+        return {
+            "workers": workers,
+            "min_threads": min_threads,
+            "max_threads": max_threads,
+            "per_worker_max_memory_mb": max_memory_mb,
+        }
+
+    @property
+    def sidekiq(self):
+        """Return the Sidekiq concurrency and queue group settings for this unit.
+
+        Each queue group is run as its own Sidekiq process. Without
+        configured groups, one process listening on all queues is run per
+        SIDEKIQ_CPUS_PER_PROCESS cores. Concurrency defaults to
+        SIDEKIQ_THREADS_PER_CPU threads per core, capped at GitLab's
+        recommended maximum per process.
+        """
+        queue_groups = [
+            group.strip()
+            for group in (self.charm_config.get("sidekiq_queue_groups") or "").split(";")
+            if group.strip()
+        ]
+        if not queue_groups:
+            queue_groups = ["*"] * max(1, self.cpu_count // SIDEKIQ_CPUS_PER_PROCESS)
+        concurrency = self.charm_config.get("sidekiq_concurrency") or min(
+            SIDEKIQ_MAX_THREADS, SIDEKIQ_THREADS_PER_CPU * self.cpu_count
+        )
+        max_concurrency = max(
+            self.charm_config.get("sidekiq_max_concurrency") or concurrency, concurrency
+        )
+        return {
+            "concurrency": concurrency,
+            "max_concurrency": max_concurrency,
+            "queue_groups": queue_groups,
+        }
+
+    @property
+    def redis_sentinels(self):
+        """Return the sentinels of the main Redis when Sentinel mode is enabled, or an empty list."""
+        if not self.charm_config.get("redis_sentinel_master"):
+            return []
+        return self.kv.get("redis_sentinels") or []
+
+    @property
+    def redis_instances(self):
+        """Return the URL of the Redis instance of each role which has its own relation."""
+        instances = OrderedDict()
+        for role in REDIS_ROLES:
+            prefix = "redis_{}".format(role)
+            host = self.kv.get("{}_host".format(prefix))
+            port = self.kv.get("{}_port".format(prefix))
+            if not (host and port):
+                continue
+            password = self.kv.get("{}_pass".format(prefix))
+            auth = ":{}@".format(quote(password, safe="")) if password else ""
+            instances[role] = "redis://{}{}:{}".format(auth, host, port)
+        return instances
+
+    @property
+    def object_store(self):
+        """Return the consolidated object storage settings, or None when not configured.
+
+        Each object type is stored in a bucket named after the configured
+        prefix. A custom endpoint, such as MinIO, is addressed path style.
+        Without access keys, the instance's IAM profile is used.
+        """
+        prefix = self.charm_config.get("object_store_bucket_prefix")
+        if not prefix:
+            return None
+        return {
+            "region": self.charm_config.get("object_store_region"),
+            "endpoint": self.charm_config.get("object_store_endpoint"),
+            "access_key": self.charm_config.get("object_store_access_key"),
+            "secret_key": self.charm_config.get("object_store_secret_key"),
+            "buckets": OrderedDict(
+                (object_type, "{}-{}".format(prefix, object_type.replace("_", "-")))
+                for object_type in OBJECT_STORE_TYPES
+            ),
+        }
+
+    @property
+    def repository_storages(self):
+        """Return the path of each repository storage, starting with the default one."""
+        storages = OrderedDict([("default", DEFAULT_GIT_DATA_DIR)])
+        storages.update(sorted((self.kv.get("repository_storages") or {}).items()))
+        return storages
+
+    @property
+    def repository_storage_weights(self):
+        """Return the weight of each repository storage when placing new projects.
+
+        The storages are those of related Gitaly units if there are any,
+        otherwise the local ones. Weights are configured as comma separated name=weight pairs.
+        Storages which aren't listed get the default weight.
+        """
+        weights = OrderedDict(
+            (name, DEFAULT_REPOSITORY_STORAGE_WEIGHT)
+            for name in (self.gitaly_storages or self.repository_storages)
+        )
+        for pair in (self.charm_config.get("repository_storage_weights") or "").split(","):
+            name, _, weight = (part.strip() for part in pair.partition("="))
+            if name in weights and weight.isdigit():
+                weights[name] = int(weight)
+        return weights
+
+    @property
+    def backup_options(self):
+        """Return the gitlab-backup create arguments which tune what is backed up and how.
+
+        Concurrency settings left at 0 keep GitLab's own defaults, which scale
+        with the unit's CPU cores. Components are skipped per the comma
+        separated backup_skip configuration. Streamed backups also skip
+        GitLab's own archive, as the charm archives the backup itself.
+        """
+        options = []
+        if self.charm_config.get("backup_max_concurrency"):
+            options.append("GITLAB_BACKUP_MAX_CONCURRENCY={}".format(
+                self.charm_config["backup_max_concurrency"]
+            ))
+        if self.charm_config.get("backup_max_storage_concurrency"):
+            options.append("GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY={}".format(
+                self.charm_config["backup_max_storage_concurrency"]
+            ))
+        skip = [
+            component.strip()
+            for component in (self.charm_config.get("backup_skip") or "").split(",")
+            if component.strip()
+        ]
+        if self.backup_stream:
+            skip.append("tar")
+        if skip:
+            options.append("SKIP={}".format(",".join(skip)))
+        return options
+
+    @property
+    def backup_stream(self):
+        """Return how backups are streamed to their destination, or None when not configured.
+
+        The destination is a command reading the compressed archive on its
+        standard input, with {name} standing for the archive file name.
+        """
+        command = self.charm_config.get("backup_stream_command")
+        if not command:
+            return None
+        compressor = self.charm_config.get("backup_stream_compression") or "zstd"
+        if compressor not in BACKUP_COMPRESSORS:
+            raise ValueError("Unsupported backup compression: {}".format(compressor))
+        compress, extension = BACKUP_COMPRESSORS[compressor]
+        return {
+            "compressor": compressor,
+            "compress": compress,
+            "extension": extension,
+            "command": shlex.split(command),
+        }
+
+    @property
+    def db_pool(self):
+        """Return the database connection pool size of each Puma and Sidekiq process.
+
+        Each thread of a process holds its own connection, so the pool must
+        fit the most threads of any web or background process the unit's
+        role runs, plus headroom.
+        """
+        threads = [0]
+        if self.role in PUMA_ROLES:
+            threads.append(self.puma["max_threads"])
+        if self.role in SIDEKIQ_ROLES:
+            threads.append(self.sidekiq["max_concurrency"])
+        return self.charm_config.get("db_pool") or max(threads) + DB_POOL_HEADROOM
+
+    @property
+    def db_client_connections(self):
+        """Return the most connections the GitLab processes run by the unit's role can open, with every pool full."""
+        processes = 0
+        if self.role in PUMA_ROLES:
+            processes += self.puma["workers"]
+        if self.role in SIDEKIQ_ROLES:
+            processes += len(self.sidekiq["queue_groups"])
+        return processes * self.db_pool
+
+    @property
+    def db_connections(self):
+        """Return the most connections a unit can open to PostgreSQL, which PgBouncer caps when enabled."""
+        if self.pgbouncer:
+            return self.pgbouncer["pool_size"]
+        return self.db_client_connections
+
+    @property
+    def pgbouncer(self):
+        """Return the bundled PgBouncer settings, or None when disabled or not using PostgreSQL.
+
+        PgBouncer listens locally and runs in transaction pooling mode,
+        connecting to the related database with GitLab's own credentials.
+        Rails authenticates to it with an MD5 hash of the same credentials.
+        Migrations and restores hold session level advisory locks, which
+        transaction pooling breaks, so per GitLab's guidance the unit which
+        runs them connects to the database directly.
+        """
+        if not self.charm_config.get("pgbouncer") or not self.database_configured("pgsql"):
+            return None
+        if self.auto_migrate:
+            return None
+        user = self.kv.get("pgsql_user")
+        password = self.kv.get("pgsql_pass")
+        return {
+            "host": self.kv.get("pgsql_host"),
+            "port": self.kv.get("pgsql_port"),
+            "dbname": self.kv.get("pgsql_db"),
+            "user": user,
+            "password": password,
+            "auth_hash": "md5" + hashlib.md5((password + user).encode("utf-8")).hexdigest(),
+            "pool_size": self.charm_config.get("pgbouncer_pool_size"),
+            "max_client_conn": self.charm_config.get("pgbouncer_max_client_conn")
+            or self.db_client_connections,
+        }
+
+    @property
+    def db_load_balancing_hosts(self):
+        """Return the PostgreSQL standbys to send read queries to, which only GitLab EE supports."""
+        if self.charm_config.get("package_name") != "gitlab-ee":
+            return []
+        return self.kv.get("pgsql_standbys") or []
+
+    @property
+    def db_max_connections(self):
+        """Return PostgreSQL's max_connections from the relation or the configured hint, or None."""
+        return (
+            self.kv.get("pgsql_max_connections")
+            or self.charm_config.get("pgsql_max_connections")
+            or None
+        )
+
+    def database_configured(self, prefix):
+        """Return True if every setting for the database saved under a KV prefix is present."""
+        return all(
+            self.kv.get("{}_{}".format(prefix, key))
+            for key in ("host", "port", "db", "user", "pass")
+        )
+
+    @property
+    def database(self):
+        """Return the settings of the preferred configured database, or None."""
+        for prefix, adapter in self.database_backends:
+            if self.database_configured(prefix):
+                return {
+                    "db_adapter": adapter,
+                    "db_host": self.kv.get("{}_host".format(prefix)),
+                    "db_port": self.kv.get("{}_port".format(prefix)),
+                    "db_database": self.kv.get("{}_db".format(prefix)),
+                    "db_user": self.kv.get("{}_user".format(prefix)),
+                    "db_password": self.kv.get("{}_pass".format(prefix)),
+                }
+        return None
+
+    def template_context(self):
+        """Return the context used to render gitlab.rb, or None without a database needed by the role."""
+        database = self.database
+        if database is None and self.role != "gitaly":
+            return None
+        context = {
+            "redis_host": self.kv.get("redis_host"),
+            "redis_port": self.kv.get("redis_port"),
+            "redis_instances": self.redis_instances,
+            "redis_password": self.kv.get("redis_pass"),
+            "redis_sentinel_master": self.charm_config.get("redis_sentinel_master"),
+            "redis_sentinels": self.redis_sentinels,
+            "http_port": self.charm_config["http_port"],
+            "ssh_host": self.ssh_host,
+            "ssh_port": self.ssh_port,
+            "smtp_enabled": self.smtp_enabled,
+            "smtp_server": self.charm_config.get("smtp_server"),
+            "smtp_port": self.charm_config.get("smtp_port"),
+            "smtp_user": self.charm_config.get("smtp_user"),
+            "smtp_password": self.charm_config.get("smtp_password"),
+            "smtp_domain": self.smtp_domain,
+            "smtp_authentication": self.charm_config.get("smtp_authentication"),
+            "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
+            "email_from": self.charm_config.get("email_from"),
+            "email_display_name": self.charm_config.get("email_display_name"),
+            "email_reply_to": self.charm_config.get("email_reply_to"),
+            "url": self.external_url,
+            "puma": self.puma,
+            "sidekiq": self.sidekiq,
+            "db_pool": self.db_pool,
+            "pgbouncer": self.pgbouncer,
+            "db_load_balancing_hosts": self.db_load_balancing_hosts,
+            "object_store": self.object_store,
+            "repository_storages": self.repository_storages,
+            "role": self.role,
+            "gitaly": self.gitaly,
+            "gitaly_storages": self.gitaly_storages,
+            "gitlab_shell_secret": self.gitlab_shell_secret,
+            "auto_migrate": self.auto_migrate,
+        }
+        context.update(database or {})
+        if context["pgbouncer"]:
+            context.update(db_host=PGBOUNCER_HOST, db_port=PGBOUNCER_PORT)
+        return context
+
 
 class GitlabHelper:
     """The GitLab helper class.
@@ -31,6 +841,11 @@ class GitlabHelper:
 
     package_name = "gitlab-ce"
     gitlab_config = "/etc/gitlab/gitlab.rb"
+    gitlab_secrets = "/etc/gitlab/gitlab-secrets.json"
+    skip_auto_reconfigure = "/etc/gitlab/skip-auto-reconfigure"
+    package_cache_dir = "/var/cache/charm-gitlab/packages"
+    backup_dir = "/var/opt/gitlab/backups"
+    profile_log = "/var/lib/charm-gitlab/hook-profile.jsonl"
 
     def __init__(self):
         """Load hookenv key/value store and charm configuration."""
@@ -41,7 +856,10 @@ class GitlabHelper:
             self.version = None
         self.set_package_name(self.charm_config["package_name"])
         self.kv = unitdata.kv()
+        self.settings = GitlabSettings(self.charm_config, self.kv)
         self.gitlab_commands_file = "/etc/gitlab/commands.load"
+        self.reconfigure_requests = []
+        self.upgrade_step_started = None
 
     def set_package_name(self, name):
         """Parse and set the package name used to install and upgrade GitLab."""
@@ -55,46 +873,158 @@ class GitlabHelper:
         host.service_restart("gitlab")
         return True
 
+    def record_profile(self, operation, seconds, exit_code=None):
+        """Append a timing record to the hook profile, keeping the most recent PROFILE_MAX_RECORDS.
+
+        Records are written as they happen, so the profile also covers
+        hooks which fail. Failure to write the profile never fails a hook.
+        """
+        record = {
+            "hook": hookenv.hook_name(),
+            "operation": operation,
+            "seconds": round(seconds, 3),
+            "exit_code": exit_code,
+            "timestamp": int(time.time()),
+        }
+        with _profile_lock:
+            try:
+                records = []
+                if os.path.exists(self.profile_log):
+                    with open(self.profile_log, "r") as profile:
+                        records = profile.readlines()
+                else:
+                    os.makedirs(os.path.dirname(self.profile_log), exist_ok=True)
+                records.append(json.dumps(record) + "\n")
+                with open(self.profile_log + ".new", "w") as profile:
+                    profile.writelines(records[-PROFILE_MAX_RECORDS:])
+                os.rename(self.profile_log + ".new", self.profile_log)
+            except (IOError, OSError) as error:
+                hookenv.log("Unable to record hook profile: {}".format(error), hookenv.WARNING)
+
+    @contextmanager
+    def profile(self, operation):
+        """Record the duration of the enclosed block in the hook profile."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record_profile(operation, time.time() - started)
+
+    def _run(self, run, cmd, **kwargs):
+        """Run a command with a subprocess function, recording its duration and exit code.
+
+        Failures without an exit code, such as a missing binary, are recorded
+        with an exit code of -1.
+        """
+        args = cmd[1:] if cmd[0] == "sudo" else cmd
+        operation = " ".join(os.path.basename(arg) for arg in args[:2])
+        started = time.time()
+        exit_code = 0
+        try:
+            return run(cmd, **kwargs)
+        except Exception as error:
+            exit_code = getattr(error, "returncode", None) or -1
+            raise
+        finally:
+            self.record_profile(operation, time.time() - started, exit_code)
+
+    def check_output(self, cmd, **kwargs):
+        """Run subprocess.check_output, recording the command in the hook profile."""
+        return self._run(subprocess.check_output, cmd, **kwargs)
+
+    def check_call(self, cmd, **kwargs):
+        """Run subprocess.check_call, recording the command in the hook profile."""
+        return self._run(subprocess.check_call, cmd, **kwargs)
+
+    def get_hook_profile(self):
+        """Return per operation timing statistics from the hook profile, slowest p95 first."""
+        samples = OrderedDict()
+        failures = {}
+        if os.path.exists(self.profile_log):
+            with open(self.profile_log, "r") as profile:
+                for line in profile:
+                    record = json.loads(line)
+                    samples.setdefault(record["operation"], []).append(record["seconds"])
+                    if record["exit_code"]:
+                        failures[record["operation"]] = failures.get(record["operation"], 0) + 1
+        stats = [
+            {
+                "operation": operation,
+                "count": len(seconds),
+                "p50": percentile(seconds, 50),
+                "p95": percentile(seconds, 95),
+                "max": max(seconds),
+                "failures": failures.get(operation, 0),
+            }
+            for operation, seconds in samples.items()
+        ]
+        return sorted(stats, key=lambda stat: stat["p95"], reverse=True)
+
+    def report_hook_profile(self):
+        """Set per operation p50/p95/max timings from recent hooks as action output."""
+        stats = self.get_hook_profile()
+        lines = ["{:<40} {:>6} {:>9} {:>9} {:>9} {:>8}".format(
+            "operation", "count", "p50", "p95", "max", "failures"
+        )]
+        for stat in stats:
+            lines.append(
+                "{operation:<40} {count:>6} {p50:>8.2f}s {p95:>8.2f}s {max:>8.2f}s {failures:>8}".format(**stat)
+            )
+        hookenv.action_set({"operations": len(stats), "report": "\n".join(lines)})
+        return stats
+
+    def report_sizing(self):
+        """Set the web server sizing computed for this unit as action output."""
+        sizing = {
+            "cpu-count": self.settings.cpu_count,
+            "total-ram-mb": self.settings.total_ram_mb,
+        }
+        for key, value in self.settings.puma.items():
+            sizing["puma.{}".format(key.replace("_", "-"))] = value
+        for key, value in self.settings.sidekiq.items():
+            if key == "queue_groups":
+                value = ";".join(value)
+            sizing["sidekiq.{}".format(key.replace("_", "-"))] = value
+        sizing["db-pool"] = self.settings.db_pool
+        sizing["db-connections"] = self.settings.db_connections
+        hookenv.action_set(sizing)
+        return sizing
+
     def get_external_uri(self):
         """Return the configured external URL from Charm configuration."""
-        configured_value = self.charm_config["external_url"]
-        if configured_value:
-            return configured_value
-        else:
-            fqdn = "http://{}".format(socket.getfqdn())
-            return fqdn
+        return self.settings.external_url
 
     def get_sshhost(self):
         """Return the host used when configuring SSH access to GitLab."""
-        url = urlparse(self.get_external_uri())
-
-        if url.hostname:
-            return url.hostname
-        else:
-            return socket.getfqdn()
+        return self.settings.ssh_host
 
     def get_sshport(self):
         """Return the host used when configuring SSH access to GitLab."""
-        if _get_flag_value("reverseproxy.configured"):
-            return self.charm_config["proxy_ssh_port"]
-        return self.charm_config["ssh_port"]
+        return self.settings.ssh_port
 
     def get_smtp_enabled(self):
         """Return True if all configuration is in place for external SMTP usage."""
-        if self.charm_config.get("smtp_server") and self.charm_config.get("smtp_port"):
-            return True
-        return False
+        return self.settings.smtp_enabled
 
     def get_smtp_domain(self):
         """Return the SMTP domain based on configuration but default to the domain portion of the external host."""
-        if self.charm_config.get("smtp_domain", None):
-            return self.charm_config.get("smtp_domain")
-        else:
-            return self.get_sshhost()
+        return self.settings.smtp_domain
 
+    @profiled
     def configure_proxy(self, proxy):
-        """Configure GitLab for operation behind a reverse proxy."""
-        url = urlparse(self.get_external_uri())
+        """Configure GitLab for operation behind a reverse proxy.
+
+        Every unit registers as a member of the same HTTP and SSH backends,
+        named after the application, so the proxy balances across them
+        and, with health checks, stops sending traffic to a unit that is
+        down or upgrading.
+        """
+        if self.settings.role not in ("all", "rails"):
+            hookenv.log(
+                "No web services in the {} role, skipping proxy registration".format(self.settings.role)
+            )
+            return
+        url = self.settings.parsed_url
 
         if url.scheme == "https":
             port = 443
@@ -105,8 +1035,9 @@ class GitlabHelper:
             networks = hookenv.network_get(proxy.relation_name)
             internal_host = networks["ingress-addresses"][0]
         else:
-            internal_host = socket.getfqdn()
+            internal_host = self.settings.fqdn
 
+        service = hookenv.service_name()
         proxy_config = [
             {
                 "mode": "http",
@@ -114,39 +1045,75 @@ class GitlabHelper:
                 "internal_host": internal_host,
                 "internal_port": self.charm_config["http_port"],
                 "subdomain": url.hostname,
+                "group_id": "{}-http".format(service),
             },
             {
                 "mode": "tcp",
                 "external_port": self.charm_config["proxy_ssh_port"],
                 "internal_host": internal_host,
                 "internal_port": self.charm_config["ssh_port"],
+                "group_id": "{}-ssh".format(service),
             },
         ]
+        if self.charm_config.get("proxy_health_check"):
+            for backend in proxy_config:
+                backend["check"] = True
         proxy.configure(proxy_config)
 
+    def check_db_connections(self):
+        """Return a warning if all units together could open more connections than PostgreSQL allows.
+
+        Returns None when the connections fit, or when max_connections is
+        unknown.
+        """
+        max_connections = self.settings.db_max_connections
+        if not max_connections:
+            return None
+        units = get_app_unit_count()
+        if self.charm_config.get("pgbouncer") and self.settings.database_configured("pgsql"):
+            # the unit running migrations bypasses PgBouncer
+            connections = (units - 1) * self.charm_config.get("pgbouncer_pool_size") + (
+                self.settings.db_client_connections
+            )
+        else:
+            connections = units * self.settings.db_connections
+        if connections <= max_connections:
+            return None
+        warning = "{} units may open {} DB connections, over max_connections {}".format(
+            units, connections, max_connections
+        )
+        hookenv.log(
+            "{}. Lower db_pool, Puma or Sidekiq concurrency, or raise max_connections".format(
+                warning
+            ),
+            hookenv.WARNING,
+        )
+        return warning
+
+    def check_pgbouncer(self):
+        """Return a warning if PgBouncer is enabled but this unit, as the leader, bypasses it.
+
+        The leader runs the migrations, so it always connects to PostgreSQL
+        directly. On a single unit the pgbouncer option has no effect at all.
+        """
+        if not self.charm_config.get("pgbouncer") or not self.settings.database_configured("pgsql"):
+            return None
+        if not self.settings.auto_migrate:
+            return None
+        if get_app_unit_count() > 1:
+            warning = "Leader connects to PostgreSQL directly, bypassing PgBouncer"
+        else:
+            warning = "PgBouncer unused on a single unit, the leader connects directly"
+        hookenv.log(warning, hookenv.WARNING)
+        return warning
+
     def mysql_configured(self):
         """Determine if we have MySQL DB configuration present."""
-        if (
-            self.kv.get("mysql_host")
-            and self.kv.get("mysql_port")
-            and self.kv.get("mysql_db")
-            and self.kv.get("mysql_user")
-            and self.kv.get("mysql_pass")
-        ):
-            return True
-        return False
+        return self.settings.database_configured("mysql")
 
     def legacy_db_configured(self):
         """Determine if we have legacy MySQL DB configuration present."""
-        if (
-            self.kv.get("db_host")
-            and self.kv.get("db_port")
-            and self.kv.get("db_db")
-            and self.kv.get("db_user")
-            and self.kv.get("db_pass")
-        ):
-            return True
-        return False
+        return self.settings.database_configured("db")
 
     def install_pgloader(self):
         """Install pgloader for migrating DB from MySQL to PostgreSQL."""
@@ -156,39 +1123,111 @@ class GitlabHelper:
         hookenv.log("Installing pgloader...", hookenv.INFO)
         apt_install("pgloader", fatal=True)
 
-    def configure_pgloader(self):
+    def pgloader_options(self, workers=0, concurrency=0, batch_rows=0, prefetch_rows=0, multiple_readers="auto"):
+        """Return the pgloader tuning for the migration, defaulting to values based on the CPU count.
+
+        A worker per core and at least pgloader's default of four are run,
+        with one more reader per table for every four cores. Multiple
+        readers split each table by its primary key, which needs more than
+        a couple of cores to pay off.
+        """
+        cpu_count = self.settings.cpu_count
+        if multiple_readers == "auto":
+            multiple_readers = cpu_count >= 4
+        else:
+            multiple_readers = multiple_readers in (True, "yes")
+        return {
+            "workers": workers or max(4, cpu_count),
+            "concurrency": concurrency or max(1, cpu_count // 4),
+            "batch_rows": batch_rows or PGLOADER_BATCH_ROWS,
+            "prefetch_rows": prefetch_rows or PGLOADER_PREFETCH_ROWS,
+            "multiple_readers": multiple_readers,
+        }
+
+    def configure_pgloader(self, options=None):
         """Render templated commands.load file for pgloader to self.gitlab_commands_file."""
         hookenv.log(
             "Rendering pgloader commands.load file to /etc/gitlab", hookenv.INFO
         )
-        templating.render(
-            "commands.load.j2",
-            self.gitlab_commands_file,
-            {
-                "pgsql_host": self.kv.get("pgsql_host"),
-                "pgsql_port": self.kv.get("pgsql_port"),
-                "pgsql_database": self.kv.get("pgsql_db"),
-                "pgsql_user": self.kv.get("pgsql_user"),
-                "pgsql_password": self.kv.get("pgsql_pass"),
-                "mysql_host": self.kv.get("mysql_host"),
-                "mysql_port": self.kv.get("mysql_port"),
-                "mysql_database": self.kv.get("mysql_db"),
-                "mysql_user": self.kv.get("mysql_user"),
-                "mysql_password": self.kv.get("mysql_pass"),
-            },
+        context = {
+            "pgsql_host": self.kv.get("pgsql_host"),
+            "pgsql_port": self.kv.get("pgsql_port"),
+            "pgsql_database": self.kv.get("pgsql_db"),
+            "pgsql_user": self.kv.get("pgsql_user"),
+            "pgsql_password": self.kv.get("pgsql_pass"),
+            "mysql_host": self.kv.get("mysql_host"),
+            "mysql_port": self.kv.get("mysql_port"),
+            "mysql_database": self.kv.get("mysql_db"),
+            "mysql_user": self.kv.get("mysql_user"),
+            "mysql_password": self.kv.get("mysql_pass"),
+        }
+        context.update(options or self.pgloader_options())
+        templating.render("commands.load.j2", self.gitlab_commands_file, context)
+
+    def report_progress(self, message):
+        """Show migration progress in the workload status and, when run from an action, the action log."""
+        hookenv.status_set("maintenance", message)
+        if hookenv.action_name():
+            subprocess.call(["action-log", message])
+
+    def stream_pgloader(self, cmd):
+        """Run pgloader, passing its output on line by line, and return the rows and seconds of each table.
+
+        Raises CalledProcessError, with the last lines of output, if pgloader fails.
+        """
+        tables = OrderedDict()
+        copied = 0
+        output = []
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
         )
-        if any_file_changed([self.gitlab_commands_file]):
-            self.run_pgloader()
+        for line in process.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            hookenv.log(line, hookenv.DEBUG)
+            output = (output + [line])[-20:]
+            copy = re.search(r"\bCOPY (\S+)", line)
+            summary = parse_pgloader_summary(line)
+            if copy:
+                copied += 1
+                self.report_progress(
+                    "pgloader: copying {}, table {}".format(copy.group(1).replace('"', ""), copied)
+                )
+            elif summary:
+                table, rows, seconds = summary
+                tables[table] = (rows, seconds)
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, cmd, output="\n".join(output))
+        return tables
 
+    @profiled
     def run_pgloader(self):
-        """Run pgloader to migrate the data."""
+        """Run pgloader to migrate the data, reporting the rows and throughput of each table."""
         hookenv.log("Running pgloader", hookenv.INFO)
         self.render_config()
-        # force a reconfigure as well
-        self.gitlab_reconfigure_run()
-        subprocess.check_output(
-            ["/usr/bin/pgloader", self.gitlab_commands_file], stderr=subprocess.STDOUT
+        # force a reconfigure as well, the schema must exist before loading data
+        self.request_reconfigure("pgloader migration")
+        self.flush_reconfigure()
+        started = time.time()
+        tables = self._run(
+            self.stream_pgloader, ["/usr/bin/pgloader", "--verbose", self.gitlab_commands_file]
         )
+        seconds = max(time.time() - started, 0.001)
+        total_rows = sum(rows for rows, _ in tables.values())
+        result = {
+            "rows": total_rows,
+            "duration": "{}s".format(int(seconds)),
+            "throughput": "{} rows/s".format(int(total_rows / seconds)),
+        }
+        for table, (rows, table_seconds) in tables.items():
+            key = table.split(".")[-1].replace("_", "-").lower()
+            result["tables.{}".format(key)] = "{} rows in {:.1f}s ({} rows/s)".format(
+                rows, table_seconds, int(rows / table_seconds) if table_seconds else rows
+            )
+        if hookenv.action_name():
+            hookenv.action_set(result)
+        return result
 
     def mysql_migrated(self):
         """Return the contents of the mysql_migration_run KV entry which is set when migration completes."""
@@ -197,8 +1236,9 @@ class GitlabHelper:
         else:
             return False
 
-    def migrate_db(self):
-        """Migrate DB contents from MySQL to PostgreSQL."""
+    @profiled
+    def migrate_db(self, workers=0, concurrency=0, batch_rows=0, prefetch_rows=0, multiple_readers="auto"):
+        """Migrate DB contents from MySQL to PostgreSQL, tuning pgloader per pgloader_options."""
         if self.mysql_configured() and self.pgsql_configured():
             hookenv.log("Migrating database from MySQL to PostgreSQL", hookenv.INFO)
             hookenv.status_set("maintenance", "Starting MySQL to PostgreSQL migration")
@@ -207,7 +1247,9 @@ class GitlabHelper:
             hookenv.status_set(
                 "maintenance", "Rendering pgloader configuration for migration"
             )
-            self.configure_pgloader()
+            self.configure_pgloader(
+                self.pgloader_options(workers, concurrency, batch_rows, prefetch_rows, multiple_readers)
+            )
             hookenv.status_set(
                 "maintenance",
                 "MySQL to PostgreSQL migration in progress via pgloader...",
@@ -235,13 +1277,7 @@ class GitlabHelper:
 
     def pgsql_configured(self):
         """Determine if we have all requried DB configuration present."""
-        if (
-            self.kv.get("pgsql_host")
-            and self.kv.get("pgsql_port")
-            and self.kv.get("pgsql_db")
-            and self.kv.get("pgsql_user")
-            and self.kv.get("pgsql_pass")
-        ):
+        if self.settings.database_configured("pgsql"):
             hookenv.log(
                 "PostgreSQL is related and configured in the charm KV store",
                 hookenv.DEBUG,
@@ -288,6 +1324,13 @@ class GitlabHelper:
             self.kv.set("pgsql_db", db.master.dbname)
             self.kv.set("pgsql_user", db.master.user)
             self.kv.set("pgsql_pass", db.master.password)
+            # sorted, so standbys listed in a different order don't change gitlab.rb
+            self.kv.set("pgsql_standbys", sorted(set(standby.host for standby in db.standbys)))
+            max_connections = get_relation_value("pgsql", "max_connections")
+            if max_connections:
+                self.kv.set("pgsql_max_connections", int(max_connections))
+            else:
+                self.kv.unset("pgsql_max_connections")
 
     def save_mysql_conf(self, db):
         """Configure GitLab with knowledge of a related PostgreSQL endpoint."""
@@ -302,24 +1345,187 @@ class GitlabHelper:
             self.kv.set("mysql_user", db.user())
             self.kv.set("mysql_pass", db.password())
 
-    def save_redis_conf(self, endpoint):
-        """Configure GitLab with knowledge of a related Redis instance."""
+    def save_redis_conf(self, endpoint, role=None):
+        """Configure GitLab with knowledge of a related Redis instance, for one role or all of them."""
         try:
             redis = endpoint.relation_data()[0]
         except IndexError:
             return  # No relation data yet
-        self.kv.set("redis_host", redis.get("host"))
-        self.kv.set("redis_port", redis.get("port"))
+        prefix = "redis_{}".format(role) if role else "redis"
+        self.kv.set("{}_host".format(prefix), redis.get("host"))
+        self.kv.set("{}_port".format(prefix), redis.get("port"))
         if redis.get("password"):
-            self.kv.set("redis_pass", redis.get("password"))
+            self.kv.set("{}_pass".format(prefix), redis.get("password"))
         else:
-            self.kv.unset("redis_pass")
+            self.kv.unset("{}_pass".format(prefix))
+        if not role:
+            self.save_redis_sentinels(endpoint.relation_data())
+
+    def save_redis_sentinels(self, units):
+        """Save the sentinel of every related Redis unit, used in Sentinel mode.
+
+        Units publishing sentinel_host or sentinel_port are reached there,
+        others on their Redis host and the configured sentinel port.
+        """
+        sentinels = []
+        for unit in units:
+            host = unit.get("sentinel_host") or unit.get("host")
+            if not host:
+                continue
+            sentinel = {
+                "host": host,
+                "port": unit.get("sentinel_port") or self.charm_config.get("redis_sentinel_port"),
+            }
+            if sentinel not in sentinels:
+                sentinels.append(sentinel)
+        self.kv.set("redis_sentinels", sorted(sentinels, key=lambda s: (s["host"], str(s["port"]))))
+
+    def remove_redis_conf(self, role=None):
+        """Remove Redis configuation from the unit KV store, for one role or all of them."""
+        prefix = "redis_{}".format(role) if role else "redis"
+        self.kv.unset("{}_host".format(prefix))
+        self.kv.unset("{}_port".format(prefix))
+        self.kv.unset("{}_pass".format(prefix))
+        if not role:
+            self.kv.unset("redis_sentinels")
+
+    def update_repository_storages(self, detaching=None):
+        """Save the path of each attached repositories storage, except one being detached."""
+        storages = {}
+        for storage_id in hookenv.storage_list("repositories") or []:
+            if storage_id == detaching:
+                continue
+            storages[storage_id.replace("/", "-")] = hookenv.storage_get("location", storage_id)
+        self.kv.set("repository_storages", storages)
+        return storages
+
+    def apply_repository_storage_weights(self):
+        """Set how new projects are weighted across repository storages, if changed since last applied.
+
+        GitLab only accepts weights for storages it knows of, so this must
+        run after a reconfigure has added new storages to its configuration.
+        The weights are stored in the database, so like migrations they are
+        only applied by the leader.
+        """
+        if not self.settings.auto_migrate or not _get_flag_value("gitlab.configured"):
+            return False
+        weights = self.settings.repository_storage_weights
+        if self.kv.get("repository_storage_weights") == weights:
+            return False
+        hookenv.log("Setting repository storage weights: {}".format(dict(weights)))
+        ruby = (
+            "ApplicationSetting.current_without_cache.update!("
+            "repository_storages_weighted: JSON.parse('{}'))".format(json.dumps(weights))
+        )
+        self.check_call(["/usr/bin/gitlab-rails", "runner", "-e", "production", ruby])
+        self.kv.set("repository_storage_weights", weights)
+        return True
+
+    def get_secret(self, key):
+        """Return a secret shared by all units in leader settings, or None until the leader sets it.
+
+        The leader generates the secret on first use.
+        """
+        secret = hookenv.leader_get(key)
+        if not secret and hookenv.is_leader():
+            secret = host.pwgen(32)
+            hookenv.leader_set({key: secret})
+        return secret
+
+    def share_secrets(self):
+        """Share the secrets generated by the leader's reconfigure with the other units.
+
+        Followers need the same gitlab-secrets.json to decrypt data the
+        leader has written to the database.
+        """
+        if not hookenv.is_leader() or not os.path.exists(self.gitlab_secrets):
+            return False
+        with open(self.gitlab_secrets, "r") as secrets_file:
+            secrets = secrets_file.read()
+        if hookenv.leader_get("gitlab-secrets") == secrets:
+            return False
+        hookenv.log("Sharing GitLab secrets with the other units")
+        hookenv.leader_set({"gitlab-secrets": secrets})
+        return True
+
+    def install_shared_secrets(self):
+        """Install the secrets shared by the leader, returning False while a follower has none yet."""
+        if hookenv.is_leader():
+            return True
+        secrets = hookenv.leader_get("gitlab-secrets")
+        if not secrets:
+            return False
+        if os.path.exists(self.gitlab_secrets):
+            with open(self.gitlab_secrets, "r") as secrets_file:
+                if secrets_file.read() == secrets:
+                    return True
+        hookenv.log("Installing GitLab secrets shared by the leader")
+        host.write_file(self.gitlab_secrets, secrets.encode("utf-8"), perms=0o600)
+        self.request_reconfigure("shared secrets changed")
+        return True
+
+    def publish_gitaly_server(self):
+        """Publish the address, token and storages of this Gitaly unit to related Rails units.
 
-    def remove_redis_conf(self):
-        """Remove Redis configuation from the unit KV store."""
-        self.kv.unset("redis_host")
-        self.kv.unset("redis_port")
-        self.kv.unset("redis_pass")
+        Nothing is published until the leader has shared the Gitaly token.
+        """
+        if self.settings.role != "gitaly":
+            return False
+        token = self.get_secret("gitaly-token")
+        if not token:
+            hookenv.log("Not publishing the Gitaly server until the leader shares the Gitaly token")
+            return False
+        settings = {
+            "address": hookenv.unit_private_ip(),
+            "port": GITALY_PORT,
+            "token": token,
+            "storages": json.dumps(list(self.settings.repository_storages)),
+        }
+        for rid in hookenv.relation_ids("gitaly-server"):
+            hookenv.relation_set(rid, settings)
+        return True
+
+    def save_gitaly_clients(self):
+        """Save the callback URL and GitLab Shell secret published by related Rails units."""
+        self.kv.set(
+            "gitaly_clients",
+            {
+                "internal_api_url": get_relation_value("gitaly-server", "internal_api_url"),
+                "shell_secret": get_relation_value("gitaly-server", "shell_secret"),
+            },
+        )
+
+    def publish_gitaly_client(self):
+        """Publish the callback URL and GitLab Shell secret of this Rails unit to related Gitaly units."""
+        if self.settings.role == "gitaly":
+            return
+        settings = {
+            "internal_api_url": self.settings.external_url,
+            "shell_secret": self.get_secret("gitlab-shell-secret"),
+        }
+        for rid in hookenv.relation_ids("gitaly"):
+            hookenv.relation_set(rid, settings)
+
+    def save_gitaly_servers(self):
+        """Save the storages served by related Gitaly units.
+
+        Storages keep the name given by their Gitaly unit, unless another
+        unit already serves a storage of that name, in which case they are
+        prefixed with the unit name.
+        """
+        storages = OrderedDict()
+        for rid in hookenv.relation_ids("gitaly"):
+            for unit in sorted(hookenv.related_units(rid)):
+                data = hookenv.relation_get(unit=unit, rid=rid) or {}
+                if not (data.get("address") and data.get("token") and data.get("storages")):
+                    continue  # Gitaly not ready yet
+                address = "tcp://{}:{}".format(data["address"], data.get("port", GITALY_PORT))
+                for name in json.loads(data["storages"]):
+                    if name in storages:
+                        name = "{}-{}".format(unit.replace("/", "-"), name)
+                    storages[name] = {"gitaly_address": address, "gitaly_token": data["token"]}
+        self.kv.set("gitaly_servers", list(storages.items()))
+        return storages
 
     def add_sources(self):
         """Ensure the GitLab apt repository is configured and updated for use."""
@@ -336,6 +1542,7 @@ class GitlabHelper:
         )
         add_source(apt_line, apt_key)
 
+    @profiled
     def fetch_gitlab_apt_package(self):
         """Return reference to GitLab package information in the APT cache."""
         self.add_sources()
@@ -388,193 +1595,492 @@ class GitlabHelper:
             hookenv.log("GitLab is not installed.")
         return installed_version
 
-    def gitlab_reconfigure_run(self):
-        """Run gitlab-ctl reconfigure."""
-        subprocess.check_output(
-            ["/usr/bin/gitlab-ctl", "reconfigure"], stderr=subprocess.STDOUT
+    def gitlab_reconfigure_run(self, env=None):
+        """Run gitlab-ctl reconfigure, with extra environment variables if given."""
+        self.check_output(
+            ["/usr/bin/gitlab-ctl", "reconfigure"],
+            stderr=subprocess.STDOUT,
+            env=dict(os.environ, **env) if env else None,
         )
 
+    def request_reconfigure(self, reason):
+        """Mark that gitlab-ctl reconfigure is needed, deferring the run to the next flush."""
+        hookenv.log("Reconfigure requested: {}".format(reason), hookenv.DEBUG)
+        self.reconfigure_requests.append(reason)
+
+    def flush_reconfigure(self, skip_post_deployment_migrations=False):
+        """Run gitlab-ctl reconfigure once if any reconfigure has been requested.
+
+        Called at the end of each hook and action, and between upgrade steps
+        which need migrations to have run before continuing. The duration of
+        an upgrade step left waiting for this reconfigure is recorded once it
+        has run. Post deployment
+        migrations are held back while a rolling upgrade is in progress, until
+        advance_rolling_upgrade runs them once every unit runs the new version.
+        """
+        if not self.reconfigure_requests:
+            return False
+        hookenv.log(
+            "Running gitlab-ctl reconfigure for {} request(s), skipped {} run(s): {}".format(
+                len(self.reconfigure_requests),
+                len(self.reconfigure_requests) - 1,
+                ", ".join(self.reconfigure_requests),
+            )
+        )
+        self.reconfigure_requests = []
+        if skip_post_deployment_migrations or hookenv.leader_get("rolling-upgrade-version"):
+            self.gitlab_reconfigure_run({"SKIP_POST_DEPLOYMENT_MIGRATIONS": "true"})
+        else:
+            self.gitlab_reconfigure_run()
+        if self.upgrade_step_started is not None:
+            self.record_upgrade_step(time.time() - self.upgrade_step_started)
+            self.upgrade_step_started = None
+        return True
+
+    @profiled
     def upgrade_package(self, version=None):
         """Upgrade GitLab to a specific version given an apt package version or wildcard."""
-        if version:
+        cached_package = self.get_cached_package(version)
+        if cached_package:
+            hookenv.log("Installing pre-staged package {}".format(cached_package))
+            apt_install(cached_package, fatal=True)
+            self.remove_cached_package(version)
+        elif version:
             apt_install("{}={}".format(self.package_name, version), fatal=True)
         else:
             apt_install("{}".format(self.package_name), fatal=True)
 
-    def upgrade_gitlab(self):
-        """Check if a major version upgrade is being performed and install upgrades in the correct order."""
-        hookenv.log("Processing pending package upgrades for GitLab")
-        # loop until we're at the right version, stepping through major versions as needed
-        # we'll also run reconfigure at each step of the upgrade, to make sure migrations are run
-        major_upgrade = False
-        while True:
+    def get_available_versions(self):
+        """Return all versions of the GitLab package in the APT index, oldest first."""
+        output = self.check_output(
+            ["apt-cache", "madison", self.package_name], universal_newlines=True
+        )
+        versions = set()
+        for line in output.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) >= 2 and fields[0] == self.package_name:
+                versions.add(fields[1])
+        return sorted(versions, key=semantic_version.Version)
+
+    def plan_upgrade(self, package=None):
+        """Return the ordered list of package versions to install to reach the desired version.
+
+        The APT index is only read once, after which every intermediate
+        install target is worked out from the available versions: the latest
+        release of each major version passed through, and the latest patch
+        release of every required upgrade stop. A step of None installs the
+        latest available package.
+        """
+        if package is None:
             package = self.fetch_gitlab_apt_package()
-            installed_version = self.get_installed_version(package)
-            if package and installed_version:
-                latest_version = self.get_latest_version(package)
-                if self.charm_config["version"]:
-                    desired_version = self.charm_config["version"]
-                else:
-                    desired_version = latest_version
-                desired_major = self.get_major_version(desired_version)
-                installed_major = self.get_major_version(installed_version)
-
-                if desired_version == installed_version:
-                    hookenv.log(
-                        "GitLab is already at configured version {}".format(
-                            desired_version
-                        )
-                    )
-                    if major_upgrade:
-                        # Return True if we have been through a major upgrade
-                        # already
-                        return True
-                    return False
-                elif desired_major == installed_major:
-                    hookenv.log(
-                        "Upgrading GitLab version {} to latest in major release {}".format(
-                            installed_version, desired_major
-                        )
-                    )
-                    self.upgrade_package("{}.*".format(desired_major))
-                    self.gitlab_reconfigure_run()
-                    return True
-                else:
-                    next_major = installed_major + 1
-                    # first, make sure we're on the latest minor for this major
-                    hookenv.log(
-                        "Upgrading GitLab version {} to latest in current major release {}".format(
-                            installed_version, installed_major
-                        )
-                    )
-                    self.upgrade_package("{}.*".format(installed_major))
-                    self.gitlab_reconfigure_run()
-                    # then, upgrade to next major
-                    hookenv.log(
-                        "Upgrading GitLab version {} to latest in next major release {}".format(
-                            installed_version, next_major
-                        )
-                    )
-                    self.upgrade_package("{}.*".format(next_major))
-                    self.gitlab_reconfigure_run()
-                    major_upgrade = True
-                    # we will loop here by default, to finish up the next upgrade steps
-                    # looping means that we will only get into more complex checking in this
-                    # branch of the logic if necessary, if we are already able to do a simple
-                    # upgrade without all this hand-holding, we will go straight there when
-                    # upgrade-gitlab is called. Wheeeeeee here we go!
-            else:
-                # not installed
-                hookenv.log("GitLab is not installed, installing...")
-                self.upgrade_package()
-                return True
+        installed_version = self.get_installed_version(package)
+        if not package or not installed_version:
+            return [self.version]
 
-    def render_config(self):
-        """Render the configuration for GitLab omnibus."""
-        if self.pgsql_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "postgresql",
-                    "db_host": self.kv.get("pgsql_host"),
-                    "db_port": self.kv.get("pgsql_port"),
-                    "db_database": self.kv.get("pgsql_db"),
-                    "db_user": self.kv.get("pgsql_user"),
-                    "db_password": self.kv.get("pgsql_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config.get("http_port"),
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
-            )
-        elif self.mysql_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "mysql2",
-                    "db_host": self.kv.get("mysql_host"),
-                    "db_port": self.kv.get("mysql_port"),
-                    "db_database": self.kv.get("mysql_db"),
-                    "db_user": self.kv.get("mysql_user"),
-                    "db_password": self.kv.get("mysql_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config["http_port"],
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
+        latest_version = self.get_latest_version(package)
+        if self.charm_config["version"]:
+            desired_version = self.charm_config["version"]
+        else:
+            desired_version = latest_version
+        desired_major = self.get_major_version(desired_version)
+        installed_major = self.get_major_version(installed_version)
+
+        installed = semantic_version.Version(installed_version)
+        desired = semantic_version.Version(desired_version)
+        if desired == installed:
+            hookenv.log(
+                "GitLab is already at configured version {}".format(desired_version)
             )
-        elif self.legacy_db_configured():
-            templating.render(
-                "gitlab.rb.j2",
-                self.gitlab_config,
-                {
-                    "db_adapter": "mysql2",
-                    "db_host": self.kv.get("db_host"),
-                    "db_port": self.kv.get("db_port"),
-                    "db_database": self.kv.get("db_db"),
-                    "db_user": self.kv.get("db_user"),
-                    "db_password": self.kv.get("db_pass"),
-                    "redis_host": self.kv.get("redis_host"),
-                    "redis_port": self.kv.get("redis_port"),
-                    "http_port": self.charm_config["http_port"],
-                    "ssh_host": self.get_sshhost(),
-                    "ssh_port": self.get_sshport(),
-                    "smtp_enabled": self.get_smtp_enabled(),
-                    "smtp_server": self.charm_config.get("smtp_server"),
-                    "smtp_port": self.charm_config.get("smtp_port"),
-                    "smtp_user": self.charm_config.get("smtp_user"),
-                    "smtp_password": self.charm_config.get("smtp_password"),
-                    "smtp_domain": self.get_smtp_domain(),
-                    "smtp_authentication": self.charm_config.get("smtp_authentication"),
-                    "smtp_tls": str(self.charm_config.get("smtp_tls")).lower(),
-                    "email_from": self.charm_config.get("email_from"),
-                    "email_display_name": self.charm_config.get("email_display_name"),
-                    "email_reply_to": self.charm_config.get("email_reply_to"),
-                    "url": self.get_external_uri(),
-                },
+            return []
+        elif desired < installed:
+            hookenv.log(
+                "GitLab version {} is newer than configured version {}, not downgrading".format(
+                    installed_version, desired_version
+                )
             )
+            return []
+
+        # patch releases within the desired release series never need a stop
+        candidates = [
+            version
+            for version in self.get_available_versions()
+            if installed < semantic_version.Version(version) < desired
+            and semantic_version.Version(version).truncate("minor") != desired.truncate("minor")
+        ]
+        stops = set(UPGRADE_STOPS)
+        series = {}
+        for version in candidates:
+            parsed = semantic_version.Version(version)
+            # each intermediate major, then each required stop, ends on its latest release
+            if installed_major <= parsed.major < desired_major:
+                series[parsed.major] = version
+            if (parsed.major, parsed.minor) in stops:
+                series[(parsed.major, parsed.minor)] = version
+
+        plan = sorted(set(series.values()), key=semantic_version.Version)
+        plan.append(desired_version)
+        hookenv.log(
+            "Planned GitLab upgrade from {}: {}".format(installed_version, " -> ".join(plan))
+        )
+        return plan
+
+    def estimate_upgrade_duration(self, plan):
+        """Return the estimated number of seconds needed to install an upgrade plan."""
+        timings = self.kv.get("upgrade_step_seconds", [])
+        if timings:
+            step_seconds = sum(timings) / len(timings)
         else:
+            step_seconds = DEFAULT_UPGRADE_STEP_SECONDS
+        return int(step_seconds * len(plan))
+
+    def record_upgrade_step(self, seconds):
+        """Record the duration of an upgrade step, keeping the most recent ten."""
+        timings = self.kv.get("upgrade_step_seconds", [])
+        timings.append(seconds)
+        self.kv.set("upgrade_step_seconds", timings[-10:])
+
+    def report_upgrade_plan(self):
+        """Set the upgrade plan and its estimated duration as action output without upgrading."""
+        plan = self.plan_upgrade()
+        steps = [version or "latest" for version in plan]
+        hookenv.action_set(
+            {
+                "plan": " -> ".join(steps) or "none",
+                "steps": len(steps),
+                "estimated-duration": "{}s".format(self.estimate_upgrade_duration(plan)),
+            }
+        )
+        return plan
+
+    def get_package_checksum(self, version):
+        """Return the SHA256 checksum the APT index lists for a GitLab package version."""
+        output = self.check_output(
+            ["apt-cache", "show", "{}={}".format(self.package_name, version)],
+            universal_newlines=True,
+        )
+        for line in output.splitlines():
+            if line.startswith("SHA256:"):
+                return line.split(":", 1)[1].strip()
+        return None
+
+    def get_cached_package_path(self, version):
+        """Return the path of a downloaded package file for a GitLab version, if present."""
+        pattern = "{}_{}_*.deb".format(self.package_name, version.replace(":", "%3a"))
+        matches = glob.glob(os.path.join(self.package_cache_dir, pattern))
+        if matches:
+            return matches[0]
+        return None
+
+    def get_cached_package(self, version):
+        """Return the path of a pre-staged package for a version if its checksum still verifies."""
+        if not version:
+            return None
+        checksum = self.kv.get("prefetched_packages", {}).get(version)
+        if not checksum:
+            return None
+        path = self.get_cached_package_path(version)
+        if path and file_sha256(path) == checksum:
+            return path
+        hookenv.log(
+            "Pre-staged package for GitLab {} is missing or corrupt, using APT".format(version),
+            hookenv.WARNING,
+        )
+        self.remove_cached_package(version)
+        return None
+
+    def remove_cached_package(self, version):
+        """Remove a pre-staged package file and its recorded checksum."""
+        path = self.get_cached_package_path(version)
+        if path:
+            os.remove(path)
+        checksums = self.kv.get("prefetched_packages", {})
+        checksums.pop(version, None)
+        self.kv.set("prefetched_packages", checksums)
+
+    @profiled
+    def download_package(self, version):
+        """Download a GitLab package version to the package cache and verify its checksum.
+
+        Returns the checksum of the verified package file.
+        """
+        checksum = self.get_package_checksum(version)
+        path = self.get_cached_package_path(version)
+        if path and file_sha256(path) == checksum:
+            hookenv.log("GitLab {} is already pre-staged at {}".format(version, path))
+            return checksum
+        hookenv.log("Downloading GitLab {} to {}".format(version, self.package_cache_dir))
+        self.check_call(
+            ["apt-get", "download", "{}={}".format(self.package_name, version)],
+            cwd=self.package_cache_dir,
+        )
+        path = self.get_cached_package_path(version)
+        if not path or file_sha256(path) != checksum:
+            if path:
+                os.remove(path)
+            raise ValueError(
+                "Checksum verification failed for downloaded GitLab {}".format(version)
+            )
+        return checksum
+
+    @profiled
+    def prefetch_upgrade(self, concurrency=2):
+        """Download every package in the upgrade plan ahead of the upgrade itself.
+
+        Downloads run in parallel, bounded by concurrency, and each package is
+        verified against the checksum in the APT index. upgrade_package will
+        install from the pre-staged files when they are present.
+        """
+        package = self.fetch_gitlab_apt_package()
+        plan = [
+            version or self.get_latest_version(package)
+            for version in self.plan_upgrade(package)
+        ]
+        if not os.path.isdir(self.package_cache_dir):
+            os.makedirs(self.package_cache_dir)
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            checksums = list(executor.map(self.download_package, plan))
+        prefetched = self.kv.get("prefetched_packages", {})
+        prefetched.update(zip(plan, checksums))
+        self.kv.set("prefetched_packages", prefetched)
+        hookenv.action_set(
+            {
+                "packages": " ".join(plan) or "none",
+                "duration": "{}s".format(int(time.time() - started)),
+            }
+        )
+        return plan
+
+    def get_package_source(self):
+        """Return the configuration which determines the GitLab package metadata."""
+        return {
+            "version": self.charm_config.get("version"),
+            "package_name": self.package_name,
+            "apt_repo": self.charm_config.get("apt_repo"),
+            "apt_key": self.charm_config.get("apt_key"),
+        }
+
+    def save_package_metadata(self, package):
+        """Cache the installed and candidate GitLab versions read from the APT index."""
+        self.kv.set(
+            "package_metadata",
+            {
+                "installed": self.get_installed_version(package),
+                "candidate": self.get_latest_version(package),
+                "timestamp": time.time(),
+                "source": self.get_package_source(),
+            },
+        )
+
+    def package_metadata_current(self):
+        """Return True if cached package metadata is fresh and shows no upgrade is needed.
+
+        The cache expires after package_cache_ttl seconds, and is invalidated
+        whenever the configured version or package source changes.
+        """
+        metadata = self.kv.get("package_metadata")
+        ttl = self.charm_config.get("package_cache_ttl")
+        if not metadata or not ttl:
+            return False
+        if metadata["source"] != self.get_package_source():
+            hookenv.log("Package source configuration changed, invalidating package metadata")
+            return False
+        if time.time() - metadata["timestamp"] > ttl:
+            return False
+        desired_version = self.charm_config["version"] or metadata["candidate"]
+        return bool(metadata["installed"]) and metadata["installed"] == desired_version
+
+    @profiled
+    def upgrade_gitlab(self, refresh=False):
+        """Install upgrades in the order worked out by plan_upgrade.
+
+        Unless refresh is set, the APT index is not read at all while the
+        cached package metadata shows GitLab is already at the desired version.
+        """
+        hookenv.log("Processing pending package upgrades for GitLab")
+        if not refresh and self.package_metadata_current():
+            hookenv.log("GitLab is at the desired version per cached package metadata")
+            return False
+
+        package = self.fetch_gitlab_apt_package()
+        if not package or not self.get_installed_version(package):
+            hookenv.log("GitLab is not installed, installing...")
+            self.upgrade_package(self.version)
+            self.kv.unset("package_metadata")
+            return True
+
+        self.save_package_metadata(package)
+        plan = self.plan_upgrade(package)
+        if not plan:
+            return False
+        if self.charm_config.get("rolling_upgrade") and get_app_unit_count() > 1:
+            # followers install exactly the version the leader installs
+            return self.start_rolling_upgrade(plan[0] or self.get_latest_version(package))
+        for version in plan:
+            hookenv.log("Upgrading GitLab to version {}".format(version))
+            started = time.time()
+            self.upgrade_package(version)
+            self.request_reconfigure("upgraded to {}".format(version))
+            if version != plan[-1]:
+                # migrations for this step must run before installing the next one
+                self.flush_reconfigure()
+                self.record_upgrade_step(time.time() - started)
+            else:
+                # the last step is recorded once its deferred reconfigure has run
+                self.upgrade_step_started = started
+        self.kv.unset("package_metadata")
+        return True
+
+    def publish_peer_version(self, version):
+        """Publish the GitLab version this unit has upgraded to on the peer relation."""
+        for rid in hookenv.relation_ids("cluster"):
+            hookenv.relation_set(rid, {"version": version})
+
+    def get_peer_versions(self):
+        """Return the version each peer unit has published, or None if it hasn't published one."""
+        return {
+            unit: hookenv.relation_get("version", unit=unit, rid=rid)
+            for rid in hookenv.relation_ids("cluster")
+            for unit in hookenv.related_units(rid)
+        }
+
+    def upgrade_rolling_step(self, version, skip_post_deployment_migrations=False):
+        """Install one rolling upgrade step and reconfigure, without omnibus reconfiguring on install."""
+        hookenv.status_set("maintenance", "Rolling upgrade to GitLab {}".format(version))
+        host.write_file(self.skip_auto_reconfigure, b"")
+        started = time.time()
+        self.upgrade_package(version)
+        self.request_reconfigure("rolling upgrade to {}".format(version))
+        self.flush_reconfigure(skip_post_deployment_migrations=skip_post_deployment_migrations)
+        self.record_upgrade_step(time.time() - started)
+        self.kv.unset("package_metadata")
+        self.kv.set("rolling_upgrade_version", version)
+        self.publish_peer_version(version)
+
+    def start_rolling_upgrade(self, version):
+        """Start a rolling upgrade to the next upgrade step, on the leader.
+
+        Following GitLab's zero downtime upgrade procedure, the leader
+        upgrades first and runs all but the post deployment migrations,
+        so that units still on the old version keep working. The other
+        units then upgrade one at a time, see advance_rolling_upgrade.
+        Followers never upgrade on their own.
+        """
+        if not hookenv.is_leader():
+            hookenv.log("Waiting for the leader to schedule the rolling upgrade to {}".format(version))
+            return False
+        if hookenv.leader_get("rolling-upgrade-version"):
+            hookenv.log(
+                "Rolling upgrade to {} in progress".format(hookenv.leader_get("rolling-upgrade-version"))
+            )
+            return False
+        hookenv.log("Starting rolling upgrade to GitLab {}".format(version))
+        self.upgrade_rolling_step(version, skip_post_deployment_migrations=True)
+        hookenv.leader_set({"rolling-upgrade-version": version})
+        self.advance_rolling_upgrade()
+        return True
+
+    def advance_rolling_upgrade(self):
+        """Let the next peer upgrade, or finish the rolling upgrade once every peer has, on the leader.
+
+        Each peer publishes the version it upgraded to on the peer relation,
+        which runs this again on the leader. Once every unit runs the new
+        version, the post deployment migrations are run.
+        """
+        version = hookenv.leader_get("rolling-upgrade-version")
+        if not hookenv.is_leader() or not version:
+            return False
+        pending = sorted(
+            unit for unit, peer_version in self.get_peer_versions().items() if peer_version != version
+        )
+        if pending:
+            if hookenv.leader_get("rolling-upgrade-unit") != pending[0]:
+                hookenv.log("Rolling upgrade to {}: upgrading {}".format(version, pending[0]))
+                hookenv.leader_set({"rolling-upgrade-unit": pending[0]})
+            return False
+        hookenv.log("Rolling upgrade to {}: running post deployment migrations".format(version))
+        self.check_output(["/usr/bin/gitlab-rake", "db:migrate"], stderr=subprocess.STDOUT)
+        if os.path.exists(self.skip_auto_reconfigure):
+            os.remove(self.skip_auto_reconfigure)
+        hookenv.leader_set({"rolling-upgrade-version": None, "rolling-upgrade-unit": None})
+        hookenv.log("Rolling upgrade to {} complete".format(version))
+        return True
+
+    def continue_rolling_upgrade(self):
+        """Upgrade this follower when the leader gives it its turn in a rolling upgrade."""
+        version = hookenv.leader_get("rolling-upgrade-version")
+        if hookenv.is_leader() or not version:
+            return False
+        if hookenv.leader_get("rolling-upgrade-unit") != hookenv.local_unit():
+            return False
+        if self.kv.get("rolling_upgrade_version") == version:
+            return False  # already upgraded, waiting for the leader to move on
+        # this unit's APT index may predate the version the leader installed
+        self.fetch_gitlab_apt_package()
+        self.upgrade_rolling_step(version)
+        if os.path.exists(self.skip_auto_reconfigure):
+            os.remove(self.skip_auto_reconfigure)
+        return True
+
+    def report_rolling_upgrade(self):
+        """Set the progress of the rolling upgrade as action output, on any unit."""
+        version = hookenv.leader_get("rolling-upgrade-version")
+        progress = {
+            "target": version or "none",
+            "upgrading-unit": hookenv.leader_get("rolling-upgrade-unit") or "none",
+        }
+        versions = self.get_peer_versions()
+        versions[hookenv.local_unit()] = self.kv.get("rolling_upgrade_version")
+        for unit, unit_version in versions.items():
+            progress["units.{}".format(unit.replace("/", "-"))] = unit_version or "unknown"
+        hookenv.action_set(progress)
+        return progress
+
+    @profiled
+    def render_config(self):
+        """Render the configuration for GitLab omnibus."""
+        if self.settings.role != "gitaly" and not (
+            self.pgsql_configured() or self.mysql_configured() or self.legacy_db_configured()
+        ):
             hookenv.status_set(
                 "blocked",
                 "DB configuration is missing. Verify database relations to continue.",
             )
             hookenv.log("Skipping configuration due to missing DB config")
             return False
-        if any_file_changed([self.gitlab_config]):
-            self.gitlab_reconfigure_run()
+        if self.settings.role == "gitaly" and not self.get_secret("gitaly-token"):
+            hookenv.status_set("waiting", "Waiting for the leader to share the Gitaly token")
+            hookenv.log("Skipping configuration until the leader shares the Gitaly token")
+            return False
+        templating.render("gitlab.rb.j2", self.gitlab_config, self.settings.template_context())
+        with open(self.gitlab_config, "r") as config_file:
+            self.apply_settings(parse_gitlab_rb(config_file.read()))
+        return True
+
+    def apply_settings(self, settings):
+        """Request a reconfigure if the effective gitlab.rb settings differ from those last applied.
+
+        Rendered changes which don't alter any setting, such as edits to the
+        reference comments shipped with the template, need no action at all.
+        """
+        previous = self.kv.get("gitlab_rb_settings")
+        if previous is not None:
+            changed = sorted(
+                key
+                for key in set(settings) | set(previous)
+                if settings.get(key) != previous.get(key)
+            )
+            if not changed:
+                hookenv.log("No effective gitlab.rb setting changes, skipping reconfigure")
+                return False
+            hookenv.log("Changed gitlab.rb settings: {}".format(", ".join(changed)))
+        self.kv.set("gitlab_rb_settings", settings)
+        self.request_reconfigure("gitlab.rb changed")
         return True
 
     def open_ports(self):
         """Open ports based on configuration."""
-        ports = ["80", str(self.charm_config["ssh_port"])]
+        ports = self.settings.ports
         opened_ports = hookenv.opened_ports()
         for open_port in opened_ports:
             port_no = open_port.split("/")[0]
@@ -591,6 +2097,7 @@ class GitlabHelper:
             port_no = open_port.split("/")[0]
             hookenv.close_port(port_no)
 
+    @profiled
     def configure(self):
         """
         Configure GitLab.
@@ -609,9 +2116,332 @@ class GitlabHelper:
 
         return True
 
+    def get_backup_path(self, backup_id):
+        """Return the path of the archive of a GitLab backup."""
+        return os.path.join(self.backup_dir, "{}_gitlab_backup.tar".format(backup_id))
+
+    def check_restore(self, backup_id):
+        """Check a backup can be restored on this unit, raising ValueError with the reason if not.
+
+        The archive must be in the backup directory and its GitLab version
+        must match the installed one, as gitlab-backup requires. The unit
+        must connect to the database directly rather than through PgBouncer.
+        """
+        if not os.path.exists(self.get_backup_path(backup_id)):
+            raise ValueError("Backup archive {} not found".format(self.get_backup_path(backup_id)))
+        backup_version = re.search(r"_(\d+\.\d+\.\d+)(?:-ee)?$", backup_id)
+        # read from dpkg rather than refreshing the APT index, which would add to the restore time
+        try:
+            installed = self.check_output(
+                ["dpkg-query", "-W", "-f=${Version}", self.package_name], universal_newlines=True
+            )
+        except subprocess.CalledProcessError:
+            installed = None
+        installed_version = re.match(r"^(\d+\.\d+\.\d+)", installed or "")
+        if not installed_version:
+            raise ValueError("GitLab is not installed")
+        if self.settings.pgbouncer:
+            raise ValueError(
+                "This unit connects to the database through PgBouncer, which restores must bypass. "
+                "Run the restore action on the leader, which connects directly"
+            )
+        if backup_version and backup_version.group(1) != installed_version.group(1):
+            raise ValueError(
+                "Backup {} was made by GitLab {}, but GitLab {} is installed".format(
+                    backup_id, backup_version.group(1), installed_version.group(1)
+                )
+            )
+
+    def restore_backup(self, backup_id, concurrency=0, storage_concurrency=0):
+        """Run gitlab-backup restore, returning the duration of each restored component.
+
+        Concurrency left at 0 falls back to the backup configuration.
+        """
+        cmd = ["sudo", "gitlab-backup", "restore", "BACKUP={}".format(backup_id), "force=yes"]
+        concurrency = concurrency or self.charm_config.get("backup_max_concurrency")
+        storage_concurrency = storage_concurrency or self.charm_config.get(
+            "backup_max_storage_concurrency"
+        )
+        if concurrency:
+            cmd.append("GITLAB_BACKUP_MAX_CONCURRENCY={}".format(concurrency))
+        if storage_concurrency:
+            cmd.append("GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY={}".format(storage_concurrency))
+        output = self.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True)
+        return parse_backup_output(output)[1]
+
+    @profiled
+    def restore(self, backup_id=None, secrets=None, concurrency=0, storage_concurrency=0):
+        """Restore a GitLab backup made by the backup action, reporting the duration of each phase.
+
+        Puma and Sidekiq are stopped while the database and repositories are
+        restored. Repositories are restored concurrently, like backups, per
+        the given concurrency or the backup configuration. A gitlab-secrets.json
+        file, such as one restored by layer-backup, is installed and shared
+        with the other units before GitLab is reconfigured and restarted.
+        """
+        phases = OrderedDict()
+
+        @contextmanager
+        def phase(name):
+            started = time.time()
+            yield
+            phases[name] = time.time() - started
+            self.record_profile("restore {}".format(name), phases[name])
+
+        with phase("preflight"):
+            backup_id = backup_id or self.get_latest_backup_id()
+            if not backup_id:
+                raise ValueError("No backup archive found in {}".format(self.backup_dir))
+            self.check_restore(backup_id)
+            if secrets and not os.path.exists(secrets):
+                raise ValueError("Secrets file {} not found".format(secrets))
+        hookenv.status_set("maintenance", "Restoring backup {}".format(backup_id))
+        with phase("stop"):
+            for service in ("puma", "sidekiq"):
+                self.check_call(["/usr/bin/gitlab-ctl", "stop", service])
+        if secrets:
+            with phase("secrets"):
+                with open(secrets, "r") as secrets_file:
+                    host.write_file(self.gitlab_secrets, secrets_file.read().encode("utf-8"), perms=0o600)
+                self.share_secrets()
+        with phase("restore"):
+            durations = self.restore_backup(backup_id, concurrency, storage_concurrency)
+        with phase("reconfigure"):
+            self.render_config()
+            self.request_reconfigure("restored backup {}".format(backup_id))
+            self.flush_reconfigure()
+        with phase("start"):
+            self.check_call(["/usr/bin/gitlab-ctl", "restart"])
+        result = {"backup-id": backup_id}
+        for name, seconds in phases.items():
+            result["phases.{}".format(name)] = "{}s".format(int(seconds))
+        for component, seconds in durations.items():
+            if seconds is not None:
+                result["components.{}".format(component)] = "{}s".format(seconds)
+        result["duration"] = "{}s".format(int(sum(phases.values())))
+        hookenv.action_set(result)
+        hookenv.status_set("active", "Restored backup {}".format(backup_id))
+        return result
+
+    def get_backup_ids(self):
+        """Return the IDs of the backup archives in the backup directory, most recent first.
+
+        Archives whose name doesn't start with the timestamp gitlab-backup
+        gives its backups, such as ones copied in by hand, are skipped.
+        """
+        backup_ids = []
+        for path in glob.glob(os.path.join(self.backup_dir, "*_gitlab_backup.tar")):
+            backup_id = os.path.basename(path)[: -len("_gitlab_backup.tar")]
+            if not re.match(r"^\d+_", backup_id):
+                hookenv.log("Skipping {}, not named after a GitLab backup ID".format(path))
+                continue
+            backup_ids.append(backup_id)
+        return sorted(backup_ids, key=lambda backup_id: int(backup_id.split("_")[0]), reverse=True)
+
+    def get_latest_backup_id(self):
+        """Return the ID of the most recent backup archive in the backup directory, or None."""
+        backup_ids = self.get_backup_ids()
+        return backup_ids[0] if backup_ids else None
+
+    def prune_backups(self):
+        """Remove the backup archives the retention configuration no longer keeps.
+
+        Archives beyond the backup_keep_count most recent, or made more than
+        backup_keep_days ago, are removed. The most recent archive is always
+        kept, as the base of the next incremental backup. Returns the IDs of
+        the removed backups.
+        """
+        keep_count = self.charm_config.get("backup_keep_count")
+        keep_days = self.charm_config.get("backup_keep_days")
+        oldest = time.time() - keep_days * 86400 if keep_days else 0
+        pruned = []
+        for index, backup_id in enumerate(self.get_backup_ids()):
+            if index == 0:
+                continue
+            if (keep_count and index >= keep_count) or int(backup_id.split("_")[0]) < oldest:
+                os.remove(self.get_backup_path(backup_id))
+                pruned.append(backup_id)
+        if pruned:
+            hookenv.log("Removed backups past retention: {}".format(", ".join(pruned)))
+        return pruned
+
+    def check_backup_archive(self, path):
+        """Return the counts of checked members of a backup archive, and the names of the damaged ones."""
+        checked = {"members": 0, "bundles": 0, "compressed": 0}
+        failed = []
+        try:
+            with tarfile.open(path, "r|*") as archive:
+                for member in archive:
+                    checked["members"] += 1
+                    if not member.isfile():
+                        continue
+                    if member.name.endswith(".bundle"):
+                        checked["bundles"] += 1
+                        intact = verify_bundle(archive.extractfile(member))
+                    elif member.name.endswith(".gz"):
+                        checked["compressed"] += 1
+                        intact = verify_gzip(archive.extractfile(member))
+                    else:
+                        continue
+                    if not intact:
+                        failed.append(member.name)
+        except (tarfile.TarError, OSError, EOFError, zlib.error) as error:
+            failed.append("{}: {}".format(os.path.basename(path), error))
+        return checked, failed
+
+    @profiled
+    def verify_backup(self, backup_id=None):
+        """Check the integrity of a backup archive, reading it as a stream without extracting it.
+
+        Each repository bundle is checked against its packfile checksum, and
+        each gzip compressed member, such as the database dump and uploads,
+        is decompressed to check its CRC. Sets the counts and any failed
+        members as action output, failing the action if there are any.
+        """
+        backup_id = backup_id or self.get_latest_backup_id()
+        if not backup_id:
+            hookenv.action_fail("No backup archive found in {}".format(self.backup_dir))
+            return False
+        path = self.get_backup_path(backup_id)
+        if not os.path.exists(path):
+            hookenv.action_fail("Backup archive {} not found".format(path))
+            return False
+        started = time.time()
+        checked, failed = self.check_backup_archive(path)
+        seconds = max(time.time() - started, 0.001)
+        hookenv.action_set(
+            {
+                "backup-id": backup_id,
+                "members": checked["members"],
+                "bundles": checked["bundles"],
+                "compressed": checked["compressed"],
+                "failed": "\n".join(failed) or "none",
+                "duration": "{}s".format(int(seconds)),
+                "throughput": "{:.1f} MB/s".format(os.path.getsize(path) / seconds / 1024 / 1024),
+            }
+        )
+        if failed:
+            hookenv.action_fail("{} member(s) of backup {} failed verification".format(len(failed), backup_id))
+        return not failed
+
+    def get_backup_staging(self, backup_id):
+        """Return the directory and entries of a backup gitlab-backup left unarchived."""
+        staging = os.path.join(self.backup_dir, backup_id)
+        if os.path.isdir(staging):
+            return staging, sorted(os.listdir(staging))
+        entries = [
+            entry
+            for entry in BACKUP_ENTRIES
+            if os.path.exists(os.path.join(self.backup_dir, entry))
+        ]
+        return self.backup_dir, entries
+
+    def remove_backup_staging(self, staging, entries):
+        """Remove an unarchived backup, leaving anything else in the backup directory alone."""
+        if staging != self.backup_dir:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        for entry in entries:
+            path = os.path.join(staging, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    @profiled
+    def stream_backup(self, backup_id):
+        """Archive an unarchived backup and pipe it through a parallel compressor to its destination.
+
+        tar and the compressor are chained by a pipe, and the compressed
+        archive is copied to the destination command in BACKUP_STREAM_CHUNK
+        sized chunks, so neither the archive nor the compressed archive are
+        written to the unit's disk and memory use stays bounded. The
+        unarchived backup is removed once every process has succeeded, and
+        kept for another attempt otherwise. Returns the stream statistics.
+        Raises ValueError if there is no unarchived backup to stream, which
+        tar would refuse to archive.
+        """
+        stream = self.settings.backup_stream
+        name = "{}_gitlab_backup.{}".format(backup_id, stream["extension"])
+        staging, entries = self.get_backup_staging(backup_id)
+        if not entries:
+            raise ValueError("Backup {} left nothing to stream in {}".format(backup_id, staging))
+        apt_install(stream["compressor"], fatal=True)
+        hookenv.log("Streaming backup {} through {}".format(name, stream["compressor"]))
+        started = time.time()
+        streamed = 0
+        processes = []
+        try:
+            tar = subprocess.Popen(["tar", "-C", staging, "-cf", "-"] + entries, stdout=subprocess.PIPE)
+            processes.append((tar, "tar"))
+            compress = subprocess.Popen(stream["compress"], stdin=tar.stdout, stdout=subprocess.PIPE)
+            processes.append((compress, stream["compressor"]))
+            tar.stdout.close()
+            destination = subprocess.Popen(
+                [arg.format(name=name) for arg in stream["command"]], stdin=subprocess.PIPE
+            )
+            processes.append((destination, stream["command"][0]))
+            for chunk in iter(lambda: compress.stdout.read(BACKUP_STREAM_CHUNK), b""):
+                destination.stdin.write(chunk)
+                streamed += len(chunk)
+            destination.stdin.close()
+            for process, cmd in processes:
+                if process.wait():
+                    raise subprocess.CalledProcessError(process.returncode, cmd)
+        except Exception:
+            for process, _ in processes:
+                if process.poll() is None:
+                    process.kill()
+            hookenv.log(
+                "Streaming backup {} failed, keeping it unarchived in {}".format(backup_id, staging),
+                hookenv.ERROR,
+            )
+            raise
+        self.remove_backup_staging(staging, entries)
+        seconds = max(time.time() - started, 0.001)
+        return {
+            "archive": name,
+            "bytes": streamed,
+            "duration": "{}s".format(int(seconds)),
+            "throughput": "{:.1f} MB/s".format(streamed / seconds / 1024 / 1024),
+        }
+
+    @profiled
     def backup(self):
-        """Run Gitlab backup and backup from layer-backup."""
-        cmd = ["sudo", "gitlab-backup", "create", "STRATEGY=copy"]
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        """Run Gitlab backup and backup from layer-backup.
+
+        With backup_incremental set, repositories are backed up incrementally
+        against the most recent archive in the backup directory, otherwise a
+        full backup is made. With backup_stream_command set, the
+        backup is streamed to its destination instead of being archived in
+        the backup directory. The duration of each component is recorded in
+        the hook profile and set as action output. Archives past the
+        retention configuration are removed once the backup is shipped.
+        """
+        cmd = ["sudo", "gitlab-backup", "create", "STRATEGY=copy"] + self.settings.backup_options
+        previous = self.get_latest_backup_id()
+        incremental = bool(self.charm_config.get("backup_incremental") and previous)
+        if incremental:
+            cmd += ["INCREMENTAL=yes", "PREVIOUS_BACKUP={}".format(previous)]
+        started = time.time()
+        output = self.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True)
+        backup_id, durations = parse_backup_output(output)
+        result = {
+            "backup-id": backup_id or "unknown",
+            "incremental": incremental,
+            "duration": "{}s".format(int(time.time() - started)),
+        }
+        for component, seconds in durations.items():
+            if seconds is None:
+                result["components.{}".format(component)] = "skipped"
+            else:
+                result["components.{}".format(component)] = "{}s".format(seconds)
+                self.record_profile("backup {}".format(component), seconds)
+        if self.settings.backup_stream and backup_id:
+            for key, value in self.stream_backup(backup_id).items():
+                result["stream.{}".format(key)] = value
         bh = BackupHelper()
         bh.backup()
+        result["pruned"] = " ".join(self.prune_backups()) or "none"
+        hookenv.action_set(result)
+        return result
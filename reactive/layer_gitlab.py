@@ -1,7 +1,7 @@
 """Provides the main reactive layer for the GitLab charm."""
 
-import socket
-import subprocess
+import functools
+import os
 
 from charmhelpers.core import hookenv
 
@@ -9,8 +9,10 @@ from charms.reactive import (
     clear_flag,
     endpoint_from_flag,
     endpoint_from_name,
+    hook,
     is_flag_set,
     set_flag,
+    toggle_flag,
     when,
     when_all,
     when_any,
@@ -18,14 +20,40 @@ from charms.reactive import (
     when_not,
 )
 
-from libgitlab import GitlabHelper
+from libgitlab import GitlabHelper, REDIS_ROLES, redis_relation_name
 
 gitlab = GitlabHelper()
+# atexit callbacks run last registered first: storage weights need the
+# storages added by the reconfigure
+hookenv.atexit(gitlab.apply_repository_storage_weights)
+# the leader's secrets only exist once its first reconfigure has run
+hookenv.atexit(gitlab.share_secrets)
+# run any reconfigure requested by this hook's handlers exactly once
+hookenv.atexit(gitlab.flush_reconfigure)
 
 HEALTHY = "GitLab installed and configured"
 
 
+def profiled(handler):
+    """Record the duration of each run of a reactive handler in the hook profile.
+
+    charms.reactive identifies handlers by their code object, which every
+    wrapper shares, unless the handler carries its own ID. The wrapper is
+    identified by the module and name of the handler it wraps, and each
+    profile record already notes the hook it was recorded in.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with gitlab.profile(handler.__name__):
+            return handler(*args, **kwargs)
+
+    wrapper._action_id = wrapper._short_action_id = "{}:{}".format(handler.__module__, handler.__name__)
+    return wrapper
+
+
 @when("pgsql.database.connected")
+@profiled
 def set_pgsql_db():
     """Set PostgreSQL database name, so the related charm will create the DB for us."""
     hookenv.log("Requesting gitlab DB from {}".format(hookenv.remote_unit()))
@@ -34,6 +62,7 @@ def set_pgsql_db():
 
 
 @when_any("pgsql.departed")
+@profiled
 def remove_pgsql():
     """Remove the PostgreSQL DB configuration when the relation has been removed."""
     hookenv.status_set("maintenance", "Cleaning up removed pgsql relation")
@@ -42,6 +71,7 @@ def remove_pgsql():
 
 
 @when_any("db.departed")
+@profiled
 def remove_mysql():
     """Remove the Legacy MySQL DB configuration when the relation has been removed."""
     hookenv.status_set("maintenance", "Cleaning up legacy MySQL relation")
@@ -50,6 +80,7 @@ def remove_mysql():
 
 
 @when("endpoint.redis.departed")
+@profiled
 def remove_redis():
     """Remove the Redis configuration when the relation has been removed."""
     hookenv.status_set("maintenance", "Cleaning up removed Redis relation")
@@ -58,7 +89,54 @@ def remove_redis():
     hookenv.status_set("active", HEALTHY)
 
 
+@when_any(
+    *["endpoint.{}.departed".format(redis_relation_name(role)) for role in REDIS_ROLES]
+)
+@profiled
+def remove_redis_roles():
+    """Move Redis roles back to the main Redis instance when their own relation is removed."""
+    hookenv.status_set("maintenance", "Cleaning up removed Redis relation")
+    for role in REDIS_ROLES:
+        flag = "endpoint.{}.departed".format(redis_relation_name(role))
+        if is_flag_set(flag):
+            hookenv.log("Removing Redis {} config".format(role))
+            gitlab.remove_redis_conf(role)
+            clear_flag(flag)
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+    hookenv.status_set("active", HEALTHY)
+
+
+@hook("repositories-storage-attached")
+@profiled
+def attach_repository_storage():
+    """Add an attached repositories volume to GitLab's repository storages."""
+    storages = gitlab.update_repository_storages()
+    hookenv.log("Repository storages attached: {}".format(", ".join(sorted(storages))))
+    gitlab.publish_gitaly_server()
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+
+
+@hook("repositories-storage-detaching")
+@profiled
+def detach_repository_storage():
+    """Remove a detaching repositories volume from GitLab's repository storages."""
+    storage_id = os.environ.get("JUJU_STORAGE_ID")
+    hookenv.log(
+        "Repository storage {} is detaching, projects stored on it will be unavailable".format(
+            storage_id
+        ),
+        hookenv.WARNING,
+    )
+    gitlab.update_repository_storages(detaching=storage_id)
+    gitlab.publish_gitaly_server()
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+
+
 @when("reverseproxy.departed")
+@profiled
 def remove_proxy():
     """Remove the haproxy configuration when the relation is removed."""
     hookenv.status_set("maintenance", "Removing reverse proxy relation")
@@ -68,7 +146,15 @@ def remove_proxy():
     clear_flag("reverseproxy.configured")
 
 
+@when("config.changed.role")
+@profiled
+def set_role():
+    """Track whether this unit only runs Gitaly, which needs no database or Redis."""
+    toggle_flag("gitlab.role.gitaly", gitlab.settings.role == "gitaly")
+
+
 @when_not("gitlab.installed")
+@profiled
 def install_gitlab():
     """Installs GitLab based on configured version."""
     hookenv.status_set("maintenance", "Installing GitLab")
@@ -79,6 +165,8 @@ def install_gitlab():
 
 @when("pgsql.database.connected")
 @when_not("pgsql.database.available")
+@when_not("gitlab.role.gitaly")
+@profiled
 def wait_pgsql():
     """Update charm status while waiting for PostgreSQL to be ready."""
     hookenv.status_set("blocked", "Waiting for PostgreSQL database")
@@ -87,6 +175,8 @@ def wait_pgsql():
 @when("gitlab.installed")
 @when_not("pgsql.database.available")
 @when("endpoint.redis.available")
+@when_not("gitlab.role.gitaly")
+@profiled
 def missing_db_relation():
     """Complains if either database relation is missing, but not the Redis one."""
     hookenv.status_set("blocked", "Missing relation to PostgreSQL")
@@ -95,6 +185,8 @@ def missing_db_relation():
 @when("gitlab.installed")
 @when_any("db.connected", "pgsql.database.available")
 @when_not("endpoint.redis.available")
+@when_not("gitlab.role.gitaly")
+@profiled
 def missing_redis_relation():
     """Complains if the Redis relation is missing, but not the DB ones."""
     hookenv.status_set("blocked", "Missing relation to Redis")
@@ -102,16 +194,33 @@ def missing_redis_relation():
 
 @when("gitlab.installed")
 @when_none("pgsql.database.available", "endpoint.redis.available")
+@when_not("gitlab.role.gitaly")
+@profiled
 def missing_all_relations():
     """Complain when neither the Redis or DB relations are related."""
     hookenv.status_set("blocked", "Missing relation to Redis and PostgreSQL")
 
 
+def save_redis_roles():
+    """Save the Redis instance of each role which has its own relation."""
+    for role in REDIS_ROLES:
+        redis = endpoint_from_flag("endpoint.{}.available".format(redis_relation_name(role)))
+        if redis:
+            gitlab.save_redis_conf(redis, role)
+
+
 @when_all("gitlab.installed", "endpoint.redis.available")
 @when_any("db.available", "pgsql.database.available")
 @when_any(
-    "config.changed", "db.changed", "pgsql.database.changed", "endpoint.redis.changed"
+    "config.changed",
+    "gitlab.secrets.changed",
+    "db.changed",
+    "pgsql.database.changed",
+    "endpoint.redis.changed",
+    *["endpoint.{}.changed".format(redis_relation_name(role)) for role in REDIS_ROLES]
 )
+@when_not("gitlab.role.gitaly")
+@profiled
 def configure_gitlab(reverseproxy, *args):
     """Upgrade and reconfigure GitLab on configuration changes.
 
@@ -122,6 +231,9 @@ def configure_gitlab(reverseproxy, *args):
     clear_flag("db.changed")
     clear_flag("pgsql.database.changed")
     clear_flag("endpoint.redis.changed")
+    clear_flag("gitlab.secrets.changed")
+    for role in REDIS_ROLES:
+        clear_flag("endpoint.{}.changed".format(redis_relation_name(role)))
 
     hookenv.status_set("maintenance", "Configuring GitLab")
     hookenv.log(
@@ -131,6 +243,7 @@ def configure_gitlab(reverseproxy, *args):
     redis = endpoint_from_flag("endpoint.redis.available")
     if redis:
         gitlab.save_redis_conf(redis)
+    save_redis_roles()
 
     if (
         is_flag_set("pgsql.database.available")
@@ -177,17 +290,98 @@ def configure_gitlab(reverseproxy, *args):
         )
         return
 
+    if not gitlab.install_shared_secrets():
+        hookenv.status_set("waiting", "Waiting for the leader to share GitLab secrets")
+        return
+
     if gitlab.pgsql_configured() and gitlab.redis_configured():
         hookenv.log("Running GitLab configuration/install")
         if gitlab.configure():
-            hookenv.status_set("active", HEALTHY)
+            hookenv.status_set(
+                "active", gitlab.check_db_connections() or gitlab.check_pgbouncer() or HEALTHY
+            )
             set_flag("gitlab.configured")
     else:
         hookenv.log("DB and/or Redis unconfigured, skipping install.")
 
 
+@when_all("gitlab.installed", "gitlab.role.gitaly")
+@when_any("config.changed", "gitaly-server.changed", "gitlab.secrets.changed")
+@profiled
+def configure_gitaly():
+    """Configure a unit running only Gitaly, serving the repositories of related Rails units."""
+    clear_flag("gitaly-server.changed")
+    clear_flag("gitlab.secrets.changed")
+    if not gitlab.install_shared_secrets():
+        hookenv.status_set("waiting", "Waiting for the leader to share GitLab secrets")
+        return
+    if not gitlab.publish_gitaly_server():
+        hookenv.status_set("waiting", "Waiting for the leader to share the Gitaly token")
+        return
+    hookenv.status_set("maintenance", "Configuring Gitaly")
+    if gitlab.configure():
+        set_flag("gitlab.configured")
+    if gitlab.settings.gitaly["internal_api_url"]:
+        hookenv.status_set("active", "Gitaly ready")
+    else:
+        hookenv.status_set("blocked", "Missing gitaly relation to GitLab Rails")
+
+
+@hook("gitaly-server-relation-{joined,changed,departed}")
+@profiled
+def update_gitaly_clients():
+    """Exchange settings with the Rails units using this Gitaly unit."""
+    gitlab.publish_gitaly_server()
+    gitlab.save_gitaly_clients()
+    set_flag("gitaly-server.changed")
+
+
+@hook("gitaly-relation-{joined,changed,departed}")
+@profiled
+def update_gitaly_servers():
+    """Exchange settings with the Gitaly units serving this unit's repositories."""
+    gitlab.publish_gitaly_client()
+    storages = gitlab.save_gitaly_servers()
+    hookenv.log("Gitaly storages: {}".format(", ".join(storages) or "local"))
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+
+
+@hook("leader-elected")
+@profiled
+def leader_elected():
+    """Run database migrations on the new leader, as well as in later hooks."""
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+
+
+@hook("leader-settings-changed")
+@profiled
+def leader_settings_changed():
+    """Apply the secrets shared by the leader to this follower."""
+    gitlab.install_shared_secrets()
+    if gitlab.continue_rolling_upgrade():
+        hookenv.status_set("active", HEALTHY)
+    gitlab.publish_gitaly_server()
+    gitlab.publish_gitaly_client()
+    if is_flag_set("gitlab.configured"):
+        gitlab.render_config()
+    else:
+        # configuration was waiting for the secrets
+        set_flag("gitlab.secrets.changed")
+
+
+@hook("cluster-relation-{joined,changed,departed}")
+@profiled
+def peers_changed():
+    """Move a rolling upgrade on to the next unit once a peer has upgraded."""
+    if gitlab.advance_rolling_upgrade():
+        hookenv.status_set("active", HEALTHY)
+
+
 @when("reverseproxy.ready")
 @when_not("reverseproxy.configured")
+@profiled
 def configure_proxy():
     """Configure reverse proxy settings when haproxy is related."""
     hookenv.status_set("maintenance", "Applying reverse proxy configuration")
@@ -209,19 +403,17 @@ def get_runner_token():
         "production",
         "STDOUT.write Gitlab::CurrentSettings.current_application_settings.runners_registration_token"
     ]
-    token = subprocess.check_output(cmd)
+    token = gitlab.check_output(cmd)
     return token.decode("utf-8")
 
 
 @when_all("endpoint.runner.joined", "gitlab.configured")
 @when_not("runner.published")
+@profiled
 def publish_runner_config():
     """Publish the configuration for a runner to register."""
     endpoint = endpoint_from_flag("endpoint.runner.joined")
-    if gitlab.charm_config["runners_bypass_proxy"]:
-        server_uri = "http://{}".format(socket.getfqdn())
-    else:
-        server_uri = gitlab.get_external_uri()
+    server_uri = gitlab.settings.runner_url
     server_token = get_runner_token()
     hookenv.log(
         "Publishing runner config uri/token: {}/{}".format(server_uri, server_token),
@@ -232,6 +424,7 @@ def publish_runner_config():
 
 
 @when("endpoint.runner.departed")
+@profiled
 def handle_runner_departed():
     """Handle relations departed."""
     clear_flag("runner.published")
@@ -299,3 +299,65 @@ async def test_reverseproxy_config(model, app, jujutools):
     public_address = app.units[0].public_address
     assert "{}:80".format(public_address) in config
     assert "{}:22".format(public_address) in config
+
+
+@pytest.mark.timeout(300)
+async def test_minio_deploy(app, jujutools):
+    """Run a local MinIO on the GitLab unit as a stand-in for S3."""
+    if app.name.endswith("jujucharms"):
+        pytest.skip("No need to test the charm deploy")
+    unit = app.units[0]
+    cmds = [
+        "curl -sSfo /usr/local/bin/minio https://dl.min.io/server/minio/release/linux-amd64/minio",
+        "curl -sSfo /usr/local/bin/mc https://dl.min.io/client/mc/release/linux-amd64/mc",
+        "chmod +x /usr/local/bin/minio /usr/local/bin/mc",
+        "MINIO_ROOT_USER=minio MINIO_ROOT_PASSWORD=minio-secret "
+        "nohup /usr/local/bin/minio server /srv/minio --address 127.0.0.1:9000 "
+        "> /var/log/minio.log 2>&1 &",
+        "sleep 5",
+        "mc alias set local http://127.0.0.1:9000 minio minio-secret",
+    ]
+    for bucket in ("artifacts", "external-diffs", "lfs", "uploads", "packages",
+                   "dependency-proxy", "terraform-state", "pages"):
+        cmds.append("mc mb --ignore-existing local/gitlab-{}".format(bucket))
+    for cmd in cmds:
+        results = await jujutools.run_command(cmd, unit)
+        assert results["Code"] == "0"
+
+
+@pytest.mark.timeout(600)
+async def test_object_store_config(model, app, jujutools):
+    """Test objects are offloaded to the local MinIO."""
+    if app.name.endswith("jujucharms"):
+        pytest.skip("No need to test the charm deploy")
+    unit = app.units[0]
+    config = {
+        "object_store_bucket_prefix": "gitlab",
+        "object_store_endpoint": "http://127.0.0.1:9000",
+        "object_store_access_key": "minio",
+        "object_store_secret_key": "minio-secret",
+    }
+    await app.set_config(config)
+    await model.block_until(lambda: app.status == "maintenance" or app.status == "error")
+    await model.block_until(lambda: app.status == "active" or app.status == "error")
+    assert app.status != "error"
+
+    gitlab_rb = await jujutools.file_contents("/etc/gitlab/gitlab.rb", unit)
+    assert "gitlab_rails['object_store']['enabled'] = true" in gitlab_rb
+    cmd = (
+        "gitlab-rails runner -e production "
+        "'puts Gitlab.config.artifacts.object_store.enabled; "
+        "puts Gitlab.config.lfs.object_store.remote_directory'"
+    )
+    results = await jujutools.run_command(cmd, unit)
+    assert results["Stdout"].split() == ["true", "gitlab-lfs"]
+
+    cmd = (
+        "gitlab-rails runner -e production "
+        "'Fog::Storage.new(Gitlab.config.uploads.object_store.connection.to_hash.deep_symbolize_keys)"
+        ".put_object(\"gitlab-uploads\", \"charm-test\", \"ok\")'"
+    )
+    results = await jujutools.run_command(cmd, unit)
+    assert results["Code"] == "0"
+    results = await jujutools.run_command("mc cat local/gitlab-uploads/charm-test", unit)
+    assert results["Stdout"] == "ok"
@@ -128,6 +128,14 @@ def mock_gitlab_hookenv_log(monkeypatch):
     return mock_log
 
 
+@pytest.fixture
+def mock_action_set(monkeypatch):
+    """Mock hookenv.action_set."""
+    mocked_action_set = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.action_set", mocked_action_set)
+    return mocked_action_set
+
+
 @pytest.fixture
 def mock_gitlab_host(monkeypatch):
     """Mock host import on libgitlab."""
@@ -201,6 +209,65 @@ def mock_template(monkeypatch):
     monkeypatch.setattr("libgitlab.templating.host.os.fchmod", mock.Mock())
 
 
+@pytest.fixture
+def mock_unit_resources(monkeypatch):
+    """Mock the CPU and memory resources of the unit."""
+    resources = {"cpu_count": 4, "total_ram_mb": 8192}
+    monkeypatch.setattr("libgitlab.get_cpu_count", lambda: resources["cpu_count"])
+    monkeypatch.setattr("libgitlab.get_total_ram_mb", lambda: resources["total_ram_mb"])
+    return resources
+
+
+@pytest.fixture
+def mock_juju_model(monkeypatch):
+    """Mock the units of the application and the data published on its relations.
+
+    Relations map each remote unit to the data it publishes, and data set
+    by this unit is collected under published.
+    """
+    model = {
+        "local_unit": "gitlab/0",
+        "units": ["gitlab/0"],
+        "relations": {},
+        "published": {},
+        "leader": True,
+        "leader_settings": {},
+    }
+
+    def relation_get(attribute=None, unit=None, rid=None):
+        data = model["relations"][rid.split(":")[0]][unit]
+        return data.get(attribute) if attribute else data
+
+    def relation_set(relation_id=None, relation_settings=None):
+        model["published"].setdefault(relation_id.split(":")[0], {}).update(relation_settings)
+
+    monkeypatch.setattr(
+        "libgitlab.hookenv.goal_state",
+        lambda: {"units": {unit: {"status": "active"} for unit in model["units"]}},
+    )
+    monkeypatch.setattr(
+        "libgitlab.hookenv.relation_ids",
+        lambda name: ["{}:1".format(name)] if name in model["relations"] else [],
+    )
+    monkeypatch.setattr(
+        "libgitlab.hookenv.related_units",
+        lambda rid: list(model["relations"][rid.split(":")[0]]),
+    )
+    monkeypatch.setattr("libgitlab.hookenv.relation_get", relation_get)
+    monkeypatch.setattr("libgitlab.hookenv.relation_set", relation_set)
+    monkeypatch.setattr("libgitlab.hookenv.unit_private_ip", lambda: "10.0.0.10")
+    monkeypatch.setattr("libgitlab.hookenv.service_name", lambda: "gitlab")
+    monkeypatch.setattr("libgitlab.hookenv.local_unit", lambda: model["local_unit"])
+    monkeypatch.setattr("libgitlab.hookenv.is_leader", lambda: model["leader"])
+    monkeypatch.setattr(
+        "libgitlab.hookenv.leader_get", lambda key=None: model["leader_settings"].get(key)
+    )
+    monkeypatch.setattr(
+        "libgitlab.hookenv.leader_set", lambda settings: model["leader_settings"].update(settings)
+    )
+    return model
+
+
 @pytest.fixture
 def mock_unit_db(monkeypatch):
     """Mock the key value store."""
@@ -223,6 +290,8 @@ def libgitlab(
     mock_template,
     mock_gitlab_subprocess,
     mock_unit_db,
+    mock_unit_resources,
+    mock_juju_model,
     mock_open_port,
     mock_close_port,
     mock_opened_ports,
@@ -243,9 +312,13 @@ def libgitlab(
     gitlab.gitlab_commands_file = commands_file.strpath
     config_file = tmpdir.join("gitlab.rb")
     gitlab.gitlab_config = config_file.strpath
+    gitlab.gitlab_secrets = tmpdir.join("gitlab-secrets.json").strpath
+    gitlab.skip_auto_reconfigure = tmpdir.join("skip-auto-reconfigure").strpath
+    gitlab.profile_log = tmpdir.join("profile", "hook-profile.jsonl").strpath
 
     # Mock host functions not appropriate for unit testing
     gitlab.fetch_gitlab_apt_package = mock.Mock()
+    gitlab.get_available_versions = mock.Mock(return_value=[])
     gitlab.gitlab_reconfigure_run = mock.Mock()
 
     # Any other functions that load the helper will get this version
@@ -3,6 +3,8 @@ import imp
 
 import mock
 
+from charmhelpers.core import unitdata
+
 
 def test_reconfigure_action(libgitlab, monkeypatch):
     """Test reconfiguration of GitLab."""
@@ -22,13 +24,114 @@ def test_upgrade_action(libgitlab, monkeypatch):
     assert mock_function.call_count == 1
 
 
+def test_upgrade_action_persists_kv(libgitlab, monkeypatch, tmpdir):
+    """Test upgrade step timings recorded by the upgrade action outlive the action."""
+    path = tmpdir.join("unit-state.db").strpath
+    monkeypatch.setattr(libgitlab, "kv", unitdata.Storage(path=path))
+    monkeypatch.setattr(libgitlab, "upgrade_gitlab", lambda refresh: libgitlab.record_upgrade_step(300))
+    imp.load_source("upgrade_gitlab", "./actions/upgrade")
+    assert unitdata.Storage(path=path).get("upgrade_step_seconds")
+
+
+def test_plan_upgrade_action(libgitlab, monkeypatch):
+    """Test reporting of the GitLab upgrade plan."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "report_upgrade_plan", mock_function)
+    assert mock_function.call_count == 0
+    imp.load_source("plan_upgrade", "./actions/plan-upgrade")
+    assert mock_function.call_count == 1
+
+
+def test_prefetch_upgrade_action(libgitlab, monkeypatch):
+    """Test pre-staging of GitLab upgrade packages."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "prefetch_upgrade", mock_function)
+    monkeypatch.setattr("libgitlab.hookenv.action_get", lambda key: 3)
+    assert mock_function.call_count == 0
+    imp.load_source("prefetch_upgrade", "./actions/prefetch-upgrade")
+    assert mock_function.call_count == 1
+    assert mock_function.call_args == mock.call(3)
+
+
+def test_prefetch_upgrade_action_persists_kv(libgitlab, monkeypatch, tmpdir):
+    """Test checksums of pre-staged packages outlive the prefetch-upgrade action."""
+    path = tmpdir.join("unit-state.db").strpath
+    monkeypatch.setattr(libgitlab, "kv", unitdata.Storage(path=path))
+    monkeypatch.setattr("libgitlab.hookenv.action_get", lambda key: 2)
+    monkeypatch.setattr(
+        libgitlab,
+        "prefetch_upgrade",
+        lambda concurrency: libgitlab.kv.set("prefetched_packages", {"1.1.1": "abc"}),
+    )
+    imp.load_source("prefetch_upgrade", "./actions/prefetch-upgrade")
+    assert unitdata.Storage(path=path).get("prefetched_packages") == {"1.1.1": "abc"}
+
+
+def test_hook_profile_action(libgitlab, monkeypatch):
+    """Test reporting of hook timings."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "report_hook_profile", mock_function)
+    assert mock_function.call_count == 0
+    imp.load_source("hook_profile", "./actions/hook-profile")
+    assert mock_function.call_count == 1
+
+
+def test_sizing_action(libgitlab, monkeypatch):
+    """Test reporting of computed sizing."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "report_sizing", mock_function)
+    assert mock_function.call_count == 0
+    imp.load_source("sizing", "./actions/sizing")
+    assert mock_function.call_count == 1
+
+
+def test_restore_action(libgitlab, monkeypatch):
+    """Test restore of a GitLab backup."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "restore", mock_function)
+    params = {
+        "backup-id": "1708621809_2024_02_22_16.9.0",
+        "secrets-file": "",
+        "concurrency": 4,
+        "storage-concurrency": 0,
+    }
+    monkeypatch.setattr("libgitlab.hookenv.action_get", lambda key: params[key])
+    assert mock_function.call_count == 0
+    imp.load_source("restore", "./actions/restore")
+    assert mock_function.call_count == 1
+    assert mock_function.call_args == mock.call("1708621809_2024_02_22_16.9.0", "", 4, 0)
+
+
+def test_verify_backup_action(libgitlab, monkeypatch):
+    """Test verification of a GitLab backup."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "verify_backup", mock_function)
+    monkeypatch.setattr("libgitlab.hookenv.action_get", lambda key: "1708621809_2024_02_22_16.9.0")
+    assert mock_function.call_count == 0
+    imp.load_source("verify_backup", "./actions/verify-backup")
+    assert mock_function.call_count == 1
+    assert mock_function.call_args == mock.call("1708621809_2024_02_22_16.9.0")
+
+
+def test_upgrade_status_action(libgitlab, monkeypatch):
+    """Test reporting of rolling upgrade progress."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(libgitlab, "report_rolling_upgrade", mock_function)
+    assert mock_function.call_count == 0
+    imp.load_source("upgrade_status", "./actions/upgrade-status")
+    assert mock_function.call_count == 1
+
+
 def test_migrate_db_action(libgitlab, monkeypatch):
     """Test migration of GitLab data."""
     mock_function = mock.Mock()
     monkeypatch.setattr(libgitlab, "migrate_db", mock_function)
+    params = {"workers": 16, "concurrency": 0, "batch-rows": 0, "prefetch-rows": 50000, "multiple-readers": "auto"}
+    monkeypatch.setattr("libgitlab.hookenv.action_get", lambda key: params[key])
     assert mock_function.call_count == 0
     imp.load_source("migratedb", "./actions/migratedb")
     assert mock_function.call_count == 1
+    assert mock_function.call_args == mock.call(16, 0, 0, 50000, "auto")
 
 
 def test_backup_action(libgitlab, monkeypatch):
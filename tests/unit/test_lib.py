@@ -1,6 +1,15 @@
 #!/usr/bin/python3
 """Test helper library usage."""
 
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tarfile
+import time
+
 import mock
 import pytest
 
@@ -38,6 +47,60 @@ def test_restart(libgitlab, mock_gitlab_host):
     assert mock_gitlab_host.service_restart.call_args == call("gitlab")
 
 
+def test_hook_profile(libgitlab, mock_gitlab_subprocess, mock_action_set, monkeypatch):
+    """Test operations and commands are timed into a bounded profile and reported."""
+    monkeypatch.setattr("libgitlab.PROFILE_MAX_RECORDS", 5)
+    # start, end and record timestamp of each operation
+    times = iter([0.0, 1.0, 0, 1.0, 3.0, 0, 3.0, 3.0, 0, 4.0, 10.0, 0])
+    monkeypatch.setattr("libgitlab.time.time", lambda: next(times))
+
+    libgitlab.check_output(["/usr/bin/gitlab-ctl", "reconfigure"])
+    libgitlab.check_output(["sudo", "gitlab-ctl", "reconfigure"])
+    with libgitlab.profile("render_config"):
+        pass
+    error = Exception("failed")
+    error.returncode = 2
+    mock_gitlab_subprocess.check_call.side_effect = error
+    with pytest.raises(Exception):
+        libgitlab.check_call(["/usr/bin/pgloader", "commands.load"])
+
+    stats = libgitlab.report_hook_profile()
+    assert stats == [
+        {"operation": "pgloader commands.load", "count": 1, "p50": 6.0, "p95": 6.0, "max": 6.0, "failures": 1},
+        {"operation": "gitlab-ctl reconfigure", "count": 2, "p50": 1.0, "p95": 2.0, "max": 2.0, "failures": 0},
+        {"operation": "render_config", "count": 1, "p50": 0.0, "p95": 0.0, "max": 0.0, "failures": 0},
+    ]
+    assert mock_action_set.call_args[0][0]["operations"] == 3
+    assert "gitlab-ctl reconfigure" in mock_action_set.call_args[0][0]["report"]
+
+    # The profile is a ring buffer of the most recent records
+    monkeypatch.setattr("libgitlab.time.time", lambda: 0.0)
+    for _ in range(10):
+        libgitlab.record_profile("configure", 0.5)
+    with open(libgitlab.profile_log) as profile:
+        assert len(profile.readlines()) == 5
+    assert libgitlab.get_hook_profile()[0]["count"] == 5
+
+    # a command which fails to start counts as failed too
+    mock_gitlab_subprocess.check_output.side_effect = FileNotFoundError("gitlab-rake")
+    with pytest.raises(FileNotFoundError):
+        libgitlab.check_output(["/usr/bin/gitlab-rake", "db:migrate"])
+    with open(libgitlab.profile_log) as profile:
+        assert json.loads(profile.readlines()[-1])["exit_code"] == -1
+    stats = {stat["operation"]: stat for stat in libgitlab.get_hook_profile()}
+    assert stats["gitlab-rake db:migrate"]["failures"] == 1
+
+
+def test_profiled_methods(libgitlab, mock_gitlab_get_flag_value):
+    """Test GitlabHelper methods are recorded in the hook profile."""
+    _configure_database("pgsql", libgitlab)
+    libgitlab.configure()
+    operations = [stat["operation"] for stat in libgitlab.get_hook_profile()]
+    assert "configure" in operations
+    assert "render_config" in operations
+    assert "upgrade_gitlab" in operations
+
+
 def test_get_external_uri(libgitlab):
     """Test get_external_uri."""
     result = libgitlab.get_external_uri()
@@ -77,6 +140,547 @@ def test_get_smtp_enabled(libgitlab, mock_gitlab_get_flag_value):
     assert result is True
 
 
+def test_settings_memoizes_lookups(libgitlab, mock_gitlab_socket, mock_gitlab_get_flag_value):
+    """Test derived settings only resolve the FQDN once per hook."""
+    _configure_database("pgsql", libgitlab)
+    libgitlab.render_config()
+    libgitlab.configure_proxy(mock.Mock())
+    assert libgitlab.settings.runner_url == "http://mock.example.com"
+    assert mock_gitlab_socket.getfqdn.call_count == 1
+
+    # The parsed URL follows configuration changes
+    libgitlab.charm_config["external_url"] = "https://gitlab.example.com"
+    assert libgitlab.settings.ssh_host == "gitlab.example.com"
+    assert libgitlab.settings.runner_url == "https://gitlab.example.com"
+    libgitlab.charm_config["runners_bypass_proxy"] = True
+    assert libgitlab.settings.runner_url == "http://mock.example.com"
+
+
+def test_settings_database(libgitlab):
+    """Test the preferred configured database is used."""
+    assert libgitlab.settings.database is None
+    assert libgitlab.settings.template_context() is None
+    _configure_database("legacy", libgitlab)
+    assert libgitlab.settings.database["db_adapter"] == "mysql2"
+    _configure_database("pgsql", libgitlab)
+    assert libgitlab.settings.database == {
+        "db_adapter": "postgresql",
+        "db_host": "host",
+        "db_port": "port",
+        "db_database": "db",
+        "db_user": "user",
+        "db_password": "pass",
+    }
+
+
+def test_settings_puma_sizing(libgitlab, mock_unit_resources):
+    """Test Puma is sized from the unit's cores and memory unless configured."""
+    assert libgitlab.settings.puma == {
+        "workers": 4,
+        "min_threads": 4,
+        "max_threads": 4,
+        "per_worker_max_memory_mb": 1664,
+    }
+
+    # Memory bound units run fewer workers, but never less than two
+    libgitlab.settings = type(libgitlab.settings)(libgitlab.charm_config, libgitlab.kv)
+    mock_unit_resources["cpu_count"] = 32
+    mock_unit_resources["total_ram_mb"] = 4096
+    assert libgitlab.settings.puma["workers"] == 2
+    assert libgitlab.settings.puma["per_worker_max_memory_mb"] == 1280
+    libgitlab.settings = type(libgitlab.settings)(libgitlab.charm_config, libgitlab.kv)
+    mock_unit_resources["total_ram_mb"] = 65536
+    assert libgitlab.settings.puma["workers"] == 32
+
+    # Configuration overrides the computed values
+    libgitlab.charm_config["puma_workers"] = 6
+    libgitlab.charm_config["puma_min_threads"] = 2
+    libgitlab.charm_config["puma_max_threads"] = 8
+    libgitlab.charm_config["puma_per_worker_max_memory_mb"] = 2048
+    assert libgitlab.settings.puma == {
+        "workers": 6,
+        "min_threads": 2,
+        "max_threads": 8,
+        "per_worker_max_memory_mb": 2048,
+    }
+
+
+def test_render_puma_settings(libgitlab):
+    """Test Puma sizing is rendered into gitlab.rb."""
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "puma['worker_processes'] = 4" in config_lines
+    assert "puma['min_threads'] = 4" in config_lines
+    assert "puma['max_threads'] = 4" in config_lines
+    assert "puma['per_worker_max_memory_mb'] = 1664" in config_lines
+
+
+def test_settings_sidekiq_sizing(libgitlab, mock_unit_resources):
+    """Test Sidekiq processes and concurrency follow the unit's cores unless configured."""
+    assert libgitlab.settings.sidekiq == {
+        "concurrency": 20,
+        "max_concurrency": 20,
+        "queue_groups": ["*"],
+    }
+
+    libgitlab.settings = type(libgitlab.settings)(libgitlab.charm_config, libgitlab.kv)
+    mock_unit_resources["cpu_count"] = 1
+    assert libgitlab.settings.sidekiq["concurrency"] == 5
+    libgitlab.settings = type(libgitlab.settings)(libgitlab.charm_config, libgitlab.kv)
+    mock_unit_resources["cpu_count"] = 16
+    assert libgitlab.settings.sidekiq["queue_groups"] == ["*", "*", "*", "*"]
+
+    libgitlab.charm_config["sidekiq_concurrency"] = 10
+    libgitlab.charm_config["sidekiq_max_concurrency"] = 15
+    libgitlab.charm_config["sidekiq_queue_groups"] = " pipeline_processing; mailers,default ;*;"
+    assert libgitlab.settings.sidekiq == {
+        "concurrency": 10,
+        "max_concurrency": 15,
+        "queue_groups": ["pipeline_processing", "mailers,default", "*"],
+    }
+
+
+def test_render_sidekiq_settings(libgitlab):
+    """Test Sidekiq settings are rendered into gitlab.rb."""
+    libgitlab.charm_config["sidekiq_queue_groups"] = "pipeline_processing;*"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "sidekiq['queue_groups'] = ['pipeline_processing', '*']" in config_lines
+    assert "sidekiq['concurrency'] = 20" in config_lines
+    assert "sidekiq['max_concurrency'] = 20" in config_lines
+
+
+def test_settings_db_pool(libgitlab):
+    """Test the DB pool fits the busiest web or background process."""
+    # 4 Puma threads, 20 Sidekiq threads, plus headroom
+    assert libgitlab.settings.db_pool == 22
+    # 4 Puma workers and 1 Sidekiq process
+    assert libgitlab.settings.db_connections == 110
+    libgitlab.charm_config["sidekiq_concurrency"] = 2
+    assert libgitlab.settings.db_pool == 6
+    libgitlab.charm_config["db_pool"] = 30
+    assert libgitlab.settings.db_pool == 30
+    assert "gitlab_rails['db_pool'] = 30" in _rendered_config("pgsql", libgitlab)
+
+
+def test_settings_db_connections_per_role(libgitlab, mock_juju_model):
+    """Test only the processes run by the unit's role count towards its DB pool and connections."""
+    libgitlab.charm_config["role"] = "rails"
+    # 4 Puma threads plus headroom, for each of 4 Puma workers
+    assert libgitlab.settings.db_pool == 6
+    assert libgitlab.settings.db_connections == 24
+    libgitlab.charm_config["role"] = "sidekiq"
+    # 20 Sidekiq threads plus headroom, for 1 Sidekiq process
+    assert libgitlab.settings.db_pool == 22
+    assert libgitlab.settings.db_connections == 22
+    libgitlab.charm_config["sidekiq_queue_groups"] = "mailers;*"
+    assert libgitlab.settings.db_connections == 44
+
+    libgitlab.charm_config["pgsql_max_connections"] = 100
+    mock_juju_model["units"] = ["gitlab/0", "gitlab/1"]
+    assert libgitlab.check_db_connections() is None
+    libgitlab.charm_config["role"] = "all"
+    assert libgitlab.check_db_connections() == (
+        "2 units may open 264 DB connections, over max_connections 100"
+    )
+
+
+def test_render_redis_instances(libgitlab):
+    """Test Redis roles with their own relation are rendered as separate instances."""
+    libgitlab.kv.set("redis_host", "redis")
+    libgitlab.kv.set("redis_port", "6379")
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert not [line for line in config_lines if line.startswith("gitlab_rails['redis_") and "_instance'] =" in line]
+
+    libgitlab.kv.set("redis_queues_host", "queues")
+    libgitlab.kv.set("redis_queues_port", "6381")
+    libgitlab.kv.set("redis_cache_host", "cache")
+    libgitlab.kv.set("redis_cache_port", "6380")
+    libgitlab.kv.set("redis_cache_pass", "p@ss/")
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert [line for line in config_lines if line.startswith("gitlab_rails['redis_") and "_instance'] =" in line] == [
+        "gitlab_rails['redis_cache_instance'] = \"redis://:p%40ss%2F@cache:6380\"",
+        "gitlab_rails['redis_queues_instance'] = \"redis://queues:6381\"",
+    ]
+    assert "gitlab_rails['redis_host'] = \"redis\"" in config_lines
+
+
+def test_render_redis_sentinels(libgitlab):
+    """Test Sentinel mode replaces the fixed Redis host."""
+    libgitlab.kv.set("redis_host", "redis0")
+    libgitlab.kv.set("redis_port", "6379")
+    libgitlab.kv.set("redis_pass", "secret")
+    libgitlab.kv.set(
+        "redis_sentinels", [{"host": "redis0", "port": 26379}, {"host": "redis1", "port": 26379}]
+    )
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['redis_host'] = \"redis0\"" in config_lines
+    assert "redis['master_name'] = \"gitlab-redis\"" not in config_lines
+
+    libgitlab.charm_config["redis_sentinel_master"] = "gitlab-redis"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['redis_host'] = \"redis0\"" not in config_lines
+    assert "redis['master_name'] = \"gitlab-redis\"" in config_lines
+    assert "redis['master_password'] = \"secret\"" in config_lines
+    assert "  { 'host' => 'redis1', 'port' => 26379 }," in config_lines
+    from libgitlab import parse_gitlab_rb
+
+    with open(libgitlab.gitlab_config, "r") as config_file:
+        settings = parse_gitlab_rb(config_file.read())
+    assert settings["gitlab_rails['redis_sentinels']"] == (
+        "[ { 'host' => 'redis0', 'port' => 26379 }, { 'host' => 'redis1', 'port' => 26379 }, ]"
+    )
+
+
+def test_render_object_store(libgitlab):
+    """Test objects are offloaded to one bucket per type when a bucket prefix is configured."""
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['object_store']['enabled'] = true" not in config_lines
+
+    libgitlab.charm_config["object_store_bucket_prefix"] = "gitlab"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['object_store']['enabled'] = true" in config_lines
+    assert "  'use_iam_profile' => true," in config_lines
+    assert "gitlab_rails['object_store']['objects']['lfs']['bucket'] = 'gitlab-lfs'" in config_lines
+    assert (
+        "gitlab_rails['object_store']['objects']['terraform_state']['bucket'] = 'gitlab-terraform-state'"
+        in config_lines
+    )
+
+    libgitlab.charm_config["object_store_endpoint"] = "http://127.0.0.1:9000"
+    libgitlab.charm_config["object_store_access_key"] = "minio"
+    libgitlab.charm_config["object_store_secret_key"] = "minio-secret"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "  'aws_access_key_id' => 'minio'," in config_lines
+    assert "  'aws_secret_access_key' => 'minio-secret'," in config_lines
+    assert "  'endpoint' => 'http://127.0.0.1:9000'," in config_lines
+    assert "  'path_style' => true," in config_lines
+    assert "  'use_iam_profile' => true," not in config_lines
+
+
+def test_update_repository_storages(libgitlab, monkeypatch):
+    """Test attached repositories volumes are saved as repository storages."""
+    monkeypatch.setattr(
+        "libgitlab.hookenv.storage_list", lambda name: ["repositories/0", "repositories/1"]
+    )
+    monkeypatch.setattr(
+        "libgitlab.hookenv.storage_get",
+        lambda attribute, storage_id: "/srv/gitlab/repositories/{}".format(storage_id[-1]),
+    )
+    libgitlab.update_repository_storages()
+    assert list(libgitlab.settings.repository_storages.items()) == [
+        ("default", "/var/opt/gitlab/git-data"),
+        ("repositories-0", "/srv/gitlab/repositories/0"),
+        ("repositories-1", "/srv/gitlab/repositories/1"),
+    ]
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert '  "repositories-1" => { "path" => "/srv/gitlab/repositories/1" },' in config_lines
+
+    libgitlab.update_repository_storages(detaching="repositories/0")
+    assert list(libgitlab.settings.repository_storages) == ["default", "repositories-1"]
+
+
+def test_repository_storage_weights(libgitlab, mock_gitlab_subprocess, mock_gitlab_get_flag_value):
+    """Test storage weights are applied through Rails only when configured and changed."""
+    libgitlab.kv.set("repository_storages", {"repositories-0": "/srv/gitlab/repositories/0"})
+    libgitlab.charm_config["repository_storage_weights"] = "default=0, repositories-0=50,bogus=1,default="
+    assert libgitlab.settings.repository_storage_weights == {"default": 0, "repositories-0": 50}
+
+    mock_gitlab_get_flag_value.return_value = None
+    assert libgitlab.apply_repository_storage_weights() is False
+    mock_gitlab_get_flag_value.return_value = True
+    assert libgitlab.apply_repository_storage_weights() is True
+    cmd = mock_gitlab_subprocess.check_call.call_args[0][0]
+    assert cmd[:4] == ["/usr/bin/gitlab-rails", "runner", "-e", "production"]
+    assert """JSON.parse('{"default": 0, "repositories-0": 50}')""" in cmd[4]
+    assert libgitlab.apply_repository_storage_weights() is False
+    assert mock_gitlab_subprocess.check_call.call_count == 1
+
+
+def test_repository_storage_weights_follower(
+    libgitlab, mock_juju_model, mock_gitlab_subprocess, mock_gitlab_get_flag_value
+):
+    """Test followers leave the storage weights, a database setting, to the leader."""
+    mock_juju_model["leader"] = False
+    mock_gitlab_get_flag_value.return_value = True
+    libgitlab.charm_config["repository_storage_weights"] = "default=100"
+    assert libgitlab.apply_repository_storage_weights() is False
+    assert mock_gitlab_subprocess.check_call.call_count == 0
+    assert libgitlab.kv.get("repository_storage_weights") is None
+
+
+def test_gitaly_role(libgitlab, mock_juju_model, mock_gitlab_host):
+    """Test a gitaly role unit only runs Gitaly, without a database, for related Rails units."""
+    mock_gitlab_host.pwgen.return_value = "gitaly-token"
+    libgitlab.charm_config["role"] = "gitaly"
+    assert libgitlab.settings.ports == ["8075"]
+    mock_juju_model["relations"]["gitaly-server"] = {
+        "gitlab/0": {"internal_api_url": "http://gitlab.example.com", "shell_secret": "shell"}
+    }
+    libgitlab.publish_gitaly_server()
+    assert mock_juju_model["published"]["gitaly-server"] == {
+        "address": "10.0.0.10",
+        "port": 8075,
+        "token": "gitaly-token",
+        "storages": '["default"]',
+    }
+    libgitlab.save_gitaly_clients()
+
+    assert libgitlab.render_config() is True
+    with open(libgitlab.gitlab_config, "r") as config_file:
+        config_lines = config_file.read().splitlines()
+    assert "puma['enable'] = false" in config_lines
+    assert "sidekiq['enable'] = false" in config_lines
+    assert "gitaly['enable'] = false" not in config_lines
+    assert "gitaly['configuration'] = {" in config_lines
+    assert '  listen_addr: "0.0.0.0:8075",' in config_lines
+    assert '    token: "gitaly-token",' in config_lines
+    assert not [line for line in config_lines if line.startswith(("gitaly['listen_addr']", "gitaly['auth_token']"))]
+    assert "gitlab_rails['internal_api_url'] = \"http://gitlab.example.com\"" in config_lines
+    assert "gitlab_shell['secret_token'] = \"shell\"" in config_lines
+    assert '  "default" => { "path" => "/var/opt/gitlab/git-data" },' in config_lines
+    assert not [line for line in config_lines if line.startswith("gitlab_rails['db_")]
+    assert not [line for line in config_lines if line.startswith("gitlab_rails['redis_")]
+
+
+def test_gitaly_role_waits_for_token(libgitlab, mock_juju_model):
+    """Test a gitaly role follower neither publishes nor renders its server before the leader shares the token."""
+    libgitlab.charm_config["role"] = "gitaly"
+    mock_juju_model["leader"] = False
+    mock_juju_model["relations"]["gitaly-server"] = {"gitlab/0": {}}
+    assert libgitlab.publish_gitaly_server() is False
+    assert "gitaly-server" not in mock_juju_model["published"]
+    assert libgitlab.render_config() is False
+    assert not os.path.exists(libgitlab.gitlab_config)
+
+    mock_juju_model["leader_settings"]["gitaly-token"] = "gitaly-token"
+    assert libgitlab.publish_gitaly_server() is True
+    assert mock_juju_model["published"]["gitaly-server"]["token"] == "gitaly-token"
+    assert libgitlab.render_config() is True
+
+
+def test_gitaly_servers(libgitlab, mock_juju_model, mock_gitlab_host):
+    """Test Rails units use the storages of related Gitaly units instead of local ones."""
+    mock_gitlab_host.pwgen.return_value = "shell"
+    mock_juju_model["relations"]["gitaly"] = {
+        "gitlab-gitaly/1": {
+            "address": "10.0.0.2",
+            "port": "8075",
+            "token": "token1",
+            "storages": '["default", "repositories-0"]',
+        },
+        "gitlab-gitaly/0": {
+            "address": "10.0.0.1",
+            "port": "8075",
+            "token": "token0",
+            "storages": '["default"]',
+        },
+        "gitlab-gitaly/2": {},
+    }
+    libgitlab.publish_gitaly_client()
+    assert mock_juju_model["published"]["gitaly"] == {
+        "internal_api_url": "http://mock.example.com",
+        "shell_secret": "shell",
+    }
+    assert list(libgitlab.save_gitaly_servers()) == [
+        "default",
+        "gitlab-gitaly-1-default",
+        "repositories-0",
+    ]
+    assert list(libgitlab.settings.repository_storage_weights) == [
+        "default",
+        "gitlab-gitaly-1-default",
+        "repositories-0",
+    ]
+
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert (
+        '  "default" => { "gitaly_address" => "tcp://10.0.0.1:8075", "gitaly_token" => "token0" },'
+        in config_lines
+    )
+    assert (
+        '  "repositories-0" => { "gitaly_address" => "tcp://10.0.0.2:8075", "gitaly_token" => "token1" },'
+        in config_lines
+    )
+    assert "gitaly['enable'] = false" in config_lines
+    assert "gitlab_shell['secret_token'] = \"shell\"" in config_lines
+
+    libgitlab.charm_config["role"] = "sidekiq"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "puma['enable'] = false" in config_lines
+    assert "sidekiq['enable'] = false" not in config_lines
+    assert libgitlab.settings.ports == []
+
+
+def test_share_secrets(libgitlab, mock_juju_model):
+    """Test the leader shares the secrets of its reconfigure and only the leader migrates."""
+    assert libgitlab.share_secrets() is False
+    with open(libgitlab.gitlab_secrets, "w") as secrets_file:
+        secrets_file.write('{"gitlab_rails": {}}')
+    assert libgitlab.share_secrets() is True
+    assert mock_juju_model["leader_settings"]["gitlab-secrets"] == '{"gitlab_rails": {}}'
+    assert libgitlab.share_secrets() is False
+    assert libgitlab.install_shared_secrets() is True
+    assert "gitlab_rails['auto_migrate'] = true" in _rendered_config("pgsql", libgitlab)
+
+    mock_juju_model["leader"] = False
+    assert libgitlab.share_secrets() is False
+    assert "gitlab_rails['auto_migrate'] = false" in _rendered_config("pgsql", libgitlab)
+
+
+def test_install_shared_secrets(libgitlab, mock_juju_model):
+    """Test followers install the leader's secrets, and wait for them when not shared yet."""
+    mock_juju_model["leader"] = False
+    assert libgitlab.install_shared_secrets() is False
+
+    mock_juju_model["leader_settings"]["gitlab-secrets"] = '{"gitlab_shell": {}}'
+    assert libgitlab.install_shared_secrets() is True
+    with open(libgitlab.gitlab_secrets, "r") as secrets_file:
+        assert secrets_file.read() == '{"gitlab_shell": {}}'
+    assert libgitlab.reconfigure_requests == ["shared secrets changed"]
+    assert libgitlab.install_shared_secrets() is True
+    assert libgitlab.reconfigure_requests == ["shared secrets changed"]
+
+
+def test_get_secret(libgitlab, mock_juju_model, mock_gitlab_host):
+    """Test secrets are generated by the leader and read by followers."""
+    mock_gitlab_host.pwgen.return_value = "generated"
+    mock_juju_model["leader"] = False
+    assert libgitlab.get_secret("gitaly-token") is None
+    mock_juju_model["leader"] = True
+    assert libgitlab.get_secret("gitaly-token") == "generated"
+    mock_gitlab_host.pwgen.return_value = "other"
+    mock_juju_model["leader"] = False
+    assert libgitlab.get_secret("gitaly-token") == "generated"
+
+
+def test_render_pgbouncer(libgitlab, mock_juju_model):
+    """Test Rails is pointed at a local PgBouncer connecting to the related database."""
+    mock_juju_model["leader"] = False
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "pgbouncer['enable'] = true" not in config_lines
+    assert libgitlab.settings.db_connections == 110
+
+    libgitlab.charm_config["pgbouncer"] = True
+    assert libgitlab.render_config() is True
+    with open(libgitlab.gitlab_config, "r") as f:
+        config_lines = f.read().splitlines()
+    assert "gitlab_rails['db_host'] = \"127.0.0.1\"" in config_lines
+    assert "gitlab_rails['db_port'] = \"6432\"" in config_lines
+    assert "gitlab_rails['db_prepared_statements'] = false" in config_lines
+    assert "pgbouncer['enable'] = true" in config_lines
+    assert "pgbouncer['pool_mode'] = \"transaction\"" in config_lines
+    assert "pgbouncer['default_pool_size'] = 20" in config_lines
+    assert "pgbouncer['max_client_conn'] = 110" in config_lines
+    assert '    host: "host",' in config_lines
+    assert '    password: "md5{}"'.format(
+        hashlib.md5(b"passuser").hexdigest()
+    ) in config_lines
+    assert libgitlab.settings.db_connections == 20
+
+    libgitlab.charm_config["pgbouncer_max_client_conn"] = 500
+    assert libgitlab.settings.pgbouncer["max_client_conn"] == 500
+
+
+def test_render_pgbouncer_migrations_bypass(libgitlab, mock_juju_model):
+    """Test the leader, which runs migrations, connects to the database directly."""
+    libgitlab.charm_config["pgbouncer"] = True
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert "gitlab_rails['auto_migrate'] = true" in config_lines
+    assert "pgbouncer['enable'] = true" not in config_lines
+    assert "gitlab_rails['db_port'] = \"6432\"" not in config_lines
+    assert libgitlab.settings.pgbouncer is None
+    assert libgitlab.settings.db_connections == 110
+
+
+def test_check_pgbouncer(libgitlab, mock_juju_model, mock_gitlab_hookenv_log):
+    """Test a warning is given when the leader bypasses the PgBouncer it was configured to use."""
+    _configure_database("pgsql", libgitlab)
+    assert libgitlab.check_pgbouncer() is None
+    libgitlab.charm_config["pgbouncer"] = True
+    assert libgitlab.check_pgbouncer() == "PgBouncer unused on a single unit, the leader connects directly"
+    mock_gitlab_hookenv_log.assert_called_with(mock.ANY, "WARNING")
+
+    mock_juju_model["units"] = ["gitlab/0", "gitlab/1"]
+    assert libgitlab.check_pgbouncer() == "Leader connects to PostgreSQL directly, bypassing PgBouncer"
+    mock_juju_model["leader"] = False
+    assert libgitlab.check_pgbouncer() is None
+
+
+def test_restore_through_pgbouncer(libgitlab, mock_juju_model, mock_gitlab_subprocess, tmpdir):
+    """Test restores are refused on units connecting to the database through PgBouncer."""
+    mock_juju_model["leader"] = False
+    libgitlab.charm_config["pgbouncer"] = True
+    _configure_database("pgsql", libgitlab)
+    libgitlab.backup_dir = tmpdir.mkdir("backups").strpath
+    tmpdir.join("backups", "1708621809_2024_02_22_16.9.0_gitlab_backup.tar").write("")
+    mock_gitlab_subprocess.check_output.return_value = "16.9.0-ce.0"
+    with pytest.raises(ValueError, match="PgBouncer"):
+        libgitlab.restore()
+    assert mock_gitlab_subprocess.check_call.call_count == 0
+
+
+def test_render_db_load_balancing(libgitlab):
+    """Test read queries are balanced across standbys on GitLab EE only."""
+    libgitlab.kv.set("pgsql_standbys", ["standby1", "standby2"])
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert not [line for line in config_lines if line.startswith("gitlab_rails['db_load_balancing']")]
+
+    libgitlab.charm_config["package_name"] = "gitlab-ee"
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert (
+        "gitlab_rails['db_load_balancing'] = { 'hosts' => ['standby1', 'standby2'] }"
+        in config_lines
+    )
+
+    libgitlab.kv.set("pgsql_standbys", [])
+    config_lines = _rendered_config("pgsql", libgitlab)
+    assert not [line for line in config_lines if line.startswith("gitlab_rails['db_load_balancing']")]
+
+
+def test_check_db_connections(libgitlab, mock_juju_model, mock_gitlab_hookenv_log):
+    """Test a warning is given when all units could exceed PostgreSQL's max_connections."""
+    assert libgitlab.check_db_connections() is None
+
+    libgitlab.charm_config["pgsql_max_connections"] = 300
+    assert libgitlab.check_db_connections() is None
+
+    mock_juju_model["units"] = ["gitlab/0", "gitlab/1", "gitlab/2"]
+    assert libgitlab.check_db_connections() == (
+        "3 units may open 330 DB connections, over max_connections 300"
+    )
+    mock_gitlab_hookenv_log.assert_called_with(mock.ANY, "WARNING")
+
+    libgitlab.kv.set("pgsql_max_connections", 500)
+    assert libgitlab.check_db_connections() is None
+
+    # with PgBouncer, only the leader opens more than the pool size
+    _configure_database("pgsql", libgitlab)
+    libgitlab.kv.set("pgsql_max_connections", 140)
+    libgitlab.charm_config["pgbouncer"] = True
+    assert libgitlab.check_db_connections() == (
+        "3 units may open 150 DB connections, over max_connections 140"
+    )
+
+
+def test_report_sizing(libgitlab, mock_action_set):
+    """Test the computed sizing is reported."""
+    libgitlab.report_sizing()
+    assert mock_action_set.call_args == call(
+        {
+            "cpu-count": 4,
+            "total-ram-mb": 8192,
+            "puma.workers": 4,
+            "puma.min-threads": 4,
+            "puma.max-threads": 4,
+            "puma.per-worker-max-memory-mb": 1664,
+            "sidekiq.concurrency": 20,
+            "sidekiq.max-concurrency": 20,
+            "sidekiq.queue-groups": "*",
+            "db-pool": 22,
+            "db-connections": 110,
+        }
+    )
+
+
 def test_ports(libgitlab, mock_open_port, mock_close_port, mock_opened_ports):
     """Test ports are opened correctly."""
     libgitlab.open_ports()
@@ -116,17 +720,35 @@ def test_configure_proxy(libgitlab, external_url, proxy_ssh_port, ssh_port):
                 "internal_host": "mock.example.com",
                 "internal_port": 80,
                 "subdomain": "mock.example.com",
+                "group_id": "gitlab-http",
+                "check": True,
             },
             {
                 "mode": "tcp",
                 "external_port": proxy_ssh_port,
                 "internal_host": "mock.example.com",
                 "internal_port": ssh_port,
+                "group_id": "gitlab-ssh",
+                "check": True,
             },
         ]
     )
 
 
+def test_configure_proxy_options(libgitlab):
+    """Test health checks can be turned off, and units without web services don't register."""
+    mock_proxy = mock.Mock()
+    libgitlab.charm_config["proxy_health_check"] = False
+    libgitlab.configure_proxy(mock_proxy)
+    for backend in mock_proxy.configure.call_args[0][0]:
+        assert "check" not in backend
+
+    mock_proxy.reset_mock()
+    libgitlab.charm_config["role"] = "sidekiq"
+    libgitlab.configure_proxy(mock_proxy)
+    assert not mock_proxy.configure.called
+
+
 def test_mysql_configured(libgitlab):
     """Test mysql_configured."""
     assert libgitlab.mysql_configured() is False
@@ -182,6 +804,118 @@ def test_configure_pgloader(libgitlab):
         in content
     )
     assert b"ALTER SCHEMA 'mysql_db' RENAME TO 'public'\n" in content
+    assert b"     data only, workers = 4, concurrency = 1,\n" in content
+    assert b"     batch rows = 25000, prefetch rows = 100000,\n" in content
+    assert b"     multiple readers per thread\n" in content
+
+
+def test_pgloader_options(libgitlab, mock_unit_resources):
+    """Test pgloader tuning defaults to values based on the CPU count."""
+    mock_unit_resources["cpu_count"] = 8
+    assert libgitlab.pgloader_options() == {
+        "workers": 8,
+        "concurrency": 2,
+        "batch_rows": 25000,
+        "prefetch_rows": 100000,
+        "multiple_readers": True,
+    }
+    options = libgitlab.pgloader_options(16, 4, 50000, 200000, "no")
+    assert options == {
+        "workers": 16,
+        "concurrency": 4,
+        "batch_rows": 50000,
+        "prefetch_rows": 200000,
+        "multiple_readers": False,
+    }
+    libgitlab.configure_pgloader(options)
+    with open(libgitlab.gitlab_commands_file, "r") as commands_file:
+        content = commands_file.read()
+    assert "workers = 16, concurrency = 4," in content
+    assert "batch rows = 50000, prefetch rows = 200000\n" in content
+    assert "multiple readers" not in content
+    libgitlab.configure_pgloader(libgitlab.pgloader_options(multiple_readers="yes"))
+    with open(libgitlab.gitlab_commands_file, "r") as commands_file:
+        assert "prefetch rows = 100000,\n     multiple readers per thread\n" in commands_file.read()
+
+
+PGLOADER_OUTPUT = """\
+2024-02-22T16:58:17.123000Z LOG pgloader version "3.6.7~devel"
+2024-02-22T16:58:18.456000Z NOTICE COPY "public"."projects"
+2024-02-22T16:58:20.456000Z NOTICE COPY "public"."merge_requests"
+
+             table name     errors       read   imported      bytes      total time       read      write
+-----------------------  ---------  ---------  ---------  ---------  --------------  ---------  ---------
+                  fetch          0          0          0                     0.002s
+-----------------------  ---------  ---------  ---------  ---------  --------------  ---------  ---------
+    "public"."projects"          0       1000       1000   123.4 kB          2.000s     1.900s     1.800s
+"public"."merge_requests"        0      50000      50000    45.6 MB       1m40.000s  1m30.000s  1m35.000s
+-----------------------  ---------  ---------  ---------  ---------  --------------  ---------  ---------
+        Total import time          ✓      51000      51000    45.7 MB       1m42.000s
+"""
+
+
+def test_parse_pgloader_summary():
+    """Test table rows of pgloader's summary are parsed, in old and new formats."""
+    from libgitlab import parse_pgloader_summary
+
+    assert parse_pgloader_summary('    "public"."projects"          0       1000   123.4 kB          2.000s') == (
+        "public.projects",
+        1000,
+        2.0,
+    )
+    assert parse_pgloader_summary(
+        '"public"."merge_requests"        0      50000      49999    45.6 MB       1h1m40.500s'
+    ) == ("public.merge_requests", 49999, 3700.5)
+    assert parse_pgloader_summary("                  fetch          0          0                     0.002s") is None
+    assert parse_pgloader_summary('2024-02-22T16:58:18.456000Z NOTICE COPY "public"."projects"') is None
+
+
+def test_run_pgloader_progress(libgitlab, mock_gitlab_subprocess, mock_action_set, monkeypatch):
+    """Test pgloader output is streamed into progress and summarised per table."""
+    monkeypatch.setattr("libgitlab.hookenv.action_name", lambda: "migratedb")
+    mock_status_set = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.status_set", mock_status_set)
+    libgitlab.render_config = mock.Mock()
+    libgitlab.gitlab_reconfigure_run = mock.Mock()
+    process = mock.Mock()
+    process.stdout = io.StringIO(PGLOADER_OUTPUT)
+    process.wait.return_value = 0
+    mock_gitlab_subprocess.Popen.return_value = process
+    result = libgitlab.run_pgloader()
+
+    assert mock_gitlab_subprocess.Popen.call_args[0][0] == [
+        "/usr/bin/pgloader",
+        "--verbose",
+        libgitlab.gitlab_commands_file,
+    ]
+    assert mock_status_set.call_args_list == [
+        call("maintenance", "pgloader: copying public.projects, table 1"),
+        call("maintenance", "pgloader: copying public.merge_requests, table 2"),
+    ]
+    assert mock_gitlab_subprocess.call.call_args == call(
+        ["action-log", "pgloader: copying public.merge_requests, table 2"]
+    )
+    assert result["rows"] == 51000
+    assert result["tables.projects"] == "1000 rows in 2.0s (500 rows/s)"
+    assert result["tables.merge-requests"] == "50000 rows in 100.0s (500 rows/s)"
+    assert mock_action_set.call_args == call(result)
+
+
+def test_run_pgloader_failure(libgitlab, mock_gitlab_subprocess):
+    """Test a failing pgloader raises with its last lines of output."""
+    libgitlab.render_config = mock.Mock()
+    libgitlab.gitlab_reconfigure_run = mock.Mock()
+    process = mock.Mock()
+    process.stdout = io.StringIO("LOG starting\nFATAL could not connect\n")
+    process.wait.return_value = 1
+    process.returncode = 1
+    mock_gitlab_subprocess.Popen.return_value = process
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        libgitlab.run_pgloader()
+    assert error.value.output == "LOG starting\nFATAL could not connect"
+    stats = {stat["operation"]: stat for stat in libgitlab.get_hook_profile()}
+    assert stats["pgloader --verbose"]["failures"] == 1
 
 
 def test_mysql_migrated(libgitlab):
@@ -280,12 +1014,26 @@ def test_save_pgsql_conf(libgitlab):
     master.user = "user"
     master.password = "password"
     db.master = master
+    db.standbys = [mock.Mock(host="standby2"), mock.Mock(host="standby1")]
     libgitlab.save_pgsql_conf(db)
     assert libgitlab.kv.get("pgsql_host") == "host"
     assert libgitlab.kv.get("pgsql_port") == "port"
     assert libgitlab.kv.get("pgsql_db") == "dbname"
     assert libgitlab.kv.get("pgsql_user") == "user"
     assert libgitlab.kv.get("pgsql_pass") == "password"
+    assert libgitlab.kv.get("pgsql_max_connections") is None
+    assert libgitlab.kv.get("pgsql_standbys") == ["standby1", "standby2"]
+
+
+def test_save_pgsql_conf_max_connections(libgitlab, mock_juju_model):
+    """Test max_connections published on the pgsql relation is saved."""
+    mock_juju_model["relations"]["pgsql"] = {"postgresql/0": {"max_connections": "100"}}
+    db = mock.Mock()
+    db.master = mock.Mock(host="host", port="port", dbname="dbname", user="user", password="password")
+    db.standbys = []
+    libgitlab.save_pgsql_conf(db)
+    assert libgitlab.kv.get("pgsql_max_connections") == 100
+    assert libgitlab.settings.db_max_connections == 100
 
 
 def test_save_mysql_conf(libgitlab):
@@ -326,6 +1074,46 @@ def test_save_redis_conf(libgitlab):
     assert not libgitlab.kv.get("redis_pass")
 
 
+def test_save_redis_role_conf(libgitlab):
+    """Test save_redis_conf for a Redis role leaves the main instance alone."""
+    endpoint = mock.Mock()
+    endpoint.relation_data.return_value = [{"host": "cache", "port": "6380", "password": "p@ss/"}]
+    libgitlab.save_redis_conf(endpoint, "cache")
+    assert libgitlab.kv.get("redis_cache_host") == "cache"
+    assert libgitlab.kv.get("redis_cache_port") == "6380"
+    assert libgitlab.kv.get("redis_cache_pass") == "p@ss/"
+    assert libgitlab.kv.get("redis_host") is None
+
+    libgitlab.remove_redis_conf("cache")
+    assert libgitlab.kv.get("redis_cache_host") is None
+    assert libgitlab.kv.get("redis_cache_pass") is None
+
+
+def test_save_redis_sentinels(libgitlab):
+    """Test the sentinel of every related Redis unit is saved."""
+    endpoint = mock.Mock()
+    endpoint.relation_data.return_value = [
+        {"host": "redis1", "port": "6379"},
+        {"host": "redis0", "port": "6379", "sentinel_port": "26380"},
+        {"host": "redis2", "port": "6379", "sentinel_host": "sentinel2"},
+        {"host": "redis1", "port": "6379"},
+        {},
+    ]
+    libgitlab.save_redis_conf(endpoint)
+    assert libgitlab.kv.get("redis_host") == "redis1"
+    assert libgitlab.kv.get("redis_sentinels") == [
+        {"host": "redis0", "port": "26380"},
+        {"host": "redis1", "port": 26379},
+        {"host": "sentinel2", "port": 26379},
+    ]
+    assert libgitlab.settings.redis_sentinels == []
+    libgitlab.charm_config["redis_sentinel_master"] = "gitlab-redis"
+    assert len(libgitlab.settings.redis_sentinels) == 3
+
+    libgitlab.remove_redis_conf()
+    assert libgitlab.kv.get("redis_sentinels") is None
+
+
 def test_remove_redis_conf(libgitlab):
     """Test remove_redis_conf."""
     libgitlab.kv.set("redis_host", "mock")
@@ -353,10 +1141,14 @@ def test_upgrade_gitlab_minor(libgitlab, mock_gitlab_hookenv_log):
         call("Processing pending package upgrades for GitLab"),
         call("Found major version 1 for GitLab version 1.1.1"),
         call("Found major version 1 for GitLab version 1.1.0"),
-        call("Upgrading GitLab version 1.1.0 to latest in major release 1"),
+        call("Planned GitLab upgrade from 1.1.0: 1.1.1"),
+        call("Upgrading GitLab to version 1.1.1"),
     ]
     mock_gitlab_hookenv_log.assert_has_calls(calls)
     assert libgitlab.get_installed_version() == "1.1.1"
+    assert libgitlab.gitlab_reconfigure_run.call_count == 0
+    assert libgitlab.flush_reconfigure() is True
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
     assert result is True
 
     # Don't upgrade if charm_config matches intalled
@@ -371,23 +1163,282 @@ def test_upgrade_gitlab_minor(libgitlab, mock_gitlab_hookenv_log):
 def test_upgrade_gitlab_major(libgitlab, mock_gitlab_hookenv_log):
     """Test the upgrade path."""
     libgitlab.get_installed_version.return_value = "0.0.0"
+    libgitlab.get_available_versions.return_value = ["0.0.0", "0.2.0", "0.2.1", "1.0.0", "1.1.1"]
     result = libgitlab.upgrade_gitlab()
     print(mock_gitlab_hookenv_log.call_args_list)
     calls = [
         call("Processing pending package upgrades for GitLab"),
         call("Found major version 1 for GitLab version 1.1.1"),
         call("Found major version 0 for GitLab version 0.0.0"),
-        call("Upgrading GitLab version 0.0.0 to latest in current major release 0"),
-        call("Upgrading GitLab version 0.0.0 to latest in next major release 1"),
-        call("Found major version 1 for GitLab version 1.1.1"),
-        call("Found major version 1 for GitLab version 1.1.1"),
-        call("GitLab is already at configured version 1.1.1"),
+        call("Planned GitLab upgrade from 0.0.0: 0.2.1 -> 1.1.1"),
+        call("Upgrading GitLab to version 0.2.1"),
+        call("Reconfigure requested: upgraded to 0.2.1", "DEBUG"),
+        call("Running gitlab-ctl reconfigure for 1 request(s), skipped 0 run(s): upgraded to 0.2.1"),
+        call("Upgrading GitLab to version 1.1.1"),
     ]
     mock_gitlab_hookenv_log.assert_has_calls(calls)
     assert libgitlab.get_installed_version() == "1.1.1"
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 1
+    # migrations run between steps, the final reconfigure waits for the flush
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+    assert len(libgitlab.kv.get("upgrade_step_seconds")) == 1
+    # the last step's timing includes its reconfigure
+    libgitlab.flush_reconfigure()
+    assert libgitlab.gitlab_reconfigure_run.call_count == 2
+    assert len(libgitlab.kv.get("upgrade_step_seconds")) == 2
+    libgitlab.request_reconfigure("gitlab.rb changed")
+    libgitlab.flush_reconfigure()
+    assert len(libgitlab.kv.get("upgrade_step_seconds")) == 2
     assert result is True
 
 
+def test_rolling_upgrade(libgitlab, mock_juju_model, mock_gitlab_subprocess, mock_action_set):
+    """Test the leader upgrades first and the followers then upgrade one at a time."""
+    libgitlab.charm_config["rolling_upgrade"] = True
+    libgitlab.get_installed_version.return_value = "1.1.0"
+    mock_juju_model["units"] = ["gitlab/0", "gitlab/1", "gitlab/2"]
+    mock_juju_model["relations"]["cluster"] = {"gitlab/2": {}, "gitlab/1": {}}
+
+    # followers never start an upgrade on their own
+    mock_juju_model["leader"] = False
+    assert libgitlab.upgrade_gitlab() is False
+    assert libgitlab.get_installed_version() == "1.1.0"
+
+    # the leader upgrades, holding back post deployment migrations
+    mock_juju_model["leader"] = True
+    assert libgitlab.upgrade_gitlab() is True
+    assert libgitlab.get_installed_version() == "1.1.1"
+    libgitlab.gitlab_reconfigure_run.assert_called_once_with({"SKIP_POST_DEPLOYMENT_MIGRATIONS": "true"})
+    assert mock_juju_model["published"]["cluster"] == {"version": "1.1.1"}
+    assert mock_juju_model["leader_settings"] == {
+        "rolling-upgrade-version": "1.1.1",
+        "rolling-upgrade-unit": "gitlab/1",
+    }
+    assert os.path.exists(libgitlab.skip_auto_reconfigure)
+    # a second run waits for the upgrade in progress
+    assert libgitlab.upgrade_gitlab(refresh=True) is False
+
+    # the follower whose turn it is upgrades, once
+    mock_juju_model["leader"] = False
+    mock_juju_model["local_unit"] = "gitlab/2"
+    assert libgitlab.continue_rolling_upgrade() is False
+    mock_juju_model["local_unit"] = "gitlab/1"
+    libgitlab.kv.unset("rolling_upgrade_version")
+    libgitlab.gitlab_reconfigure_run.reset_mock()
+    libgitlab.fetch_gitlab_apt_package.reset_mock()
+    libgitlab.get_installed_version.return_value = "1.1.0"
+    assert libgitlab.continue_rolling_upgrade() is True
+    libgitlab.gitlab_reconfigure_run.assert_called_once_with({"SKIP_POST_DEPLOYMENT_MIGRATIONS": "true"})
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 1
+    assert libgitlab.get_installed_version() == "1.1.1"
+    assert libgitlab.continue_rolling_upgrade() is False
+
+    libgitlab.report_rolling_upgrade()
+    mock_action_set.assert_called_with(
+        {
+            "target": "1.1.1",
+            "upgrading-unit": "gitlab/1",
+            "units.gitlab-2": "unknown",
+            "units.gitlab-1": "1.1.1",
+        }
+    )
+
+    # the leader moves on to the next follower, then finishes
+    mock_juju_model["leader"] = True
+    mock_juju_model["relations"]["cluster"]["gitlab/1"]["version"] = "1.1.1"
+    assert libgitlab.advance_rolling_upgrade() is False
+    assert mock_juju_model["leader_settings"]["rolling-upgrade-unit"] == "gitlab/2"
+    mock_juju_model["relations"]["cluster"]["gitlab/2"]["version"] = "1.1.1"
+    assert libgitlab.advance_rolling_upgrade() is True
+    assert mock_gitlab_subprocess.check_output.call_args[0][0] == ["/usr/bin/gitlab-rake", "db:migrate"]
+    assert mock_juju_model["leader_settings"]["rolling-upgrade-version"] is None
+    assert not os.path.exists(libgitlab.skip_auto_reconfigure)
+    assert libgitlab.advance_rolling_upgrade() is False
+
+
+def test_rolling_upgrade_config_change(libgitlab, mock_juju_model):
+    """Test a reconfigure during a rolling upgrade holds back post deployment migrations."""
+    mock_juju_model["leader_settings"]["rolling-upgrade-version"] = "1.1.1"
+    libgitlab.request_reconfigure("gitlab.rb changed")
+    assert libgitlab.flush_reconfigure() is True
+    libgitlab.gitlab_reconfigure_run.assert_called_once_with({"SKIP_POST_DEPLOYMENT_MIGRATIONS": "true"})
+
+    # once the rolling upgrade completes, reconfigure runs them again
+    mock_juju_model["leader_settings"]["rolling-upgrade-version"] = None
+    libgitlab.gitlab_reconfigure_run.reset_mock()
+    libgitlab.request_reconfigure("gitlab.rb changed")
+    assert libgitlab.flush_reconfigure() is True
+    libgitlab.gitlab_reconfigure_run.assert_called_once_with()
+
+
+def test_rolling_upgrade_exact_version(libgitlab, mock_juju_model):
+    """Test a rolling upgrade to the latest package pins the leader's exact version for followers."""
+    libgitlab.charm_config["rolling_upgrade"] = True
+    libgitlab.get_installed_version.return_value = "1.1.0"
+    libgitlab.plan_upgrade = mock.Mock(return_value=[None])
+    mock_juju_model["units"] = ["gitlab/0", "gitlab/1"]
+    mock_juju_model["relations"]["cluster"] = {"gitlab/1": {}}
+    assert libgitlab.upgrade_gitlab() is True
+    assert mock_juju_model["leader_settings"]["rolling-upgrade-version"] == "1.1.1"
+    assert libgitlab.get_installed_version() == "1.1.1"
+
+
+def test_plan_upgrade_required_stops(libgitlab):
+    """Test the upgrade plan passes through every required upgrade stop."""
+    libgitlab.get_installed_version.return_value = "12.9.2-ce.0"
+    libgitlab.get_latest_version.return_value = "13.2.1-ce.0"
+    libgitlab.get_available_versions.return_value = [
+        "12.9.2-ce.0",
+        "12.10.1-ce.0",
+        "12.10.14-ce.0",
+        "13.0.1-ce.0",
+        "13.0.14-ce.0",
+        "13.1.0-ce.0",
+        "13.1.11-ce.0",
+        "13.2.0-ce.0",
+        "13.2.1-ce.0",
+    ]
+    assert libgitlab.plan_upgrade() == [
+        "12.10.14-ce.0",
+        "13.0.14-ce.0",
+        "13.1.11-ce.0",
+        "13.2.1-ce.0",
+    ]
+
+    # A configured version stops the plan early
+    libgitlab.charm_config["version"] = "13.0.14-ce.0"
+    assert libgitlab.plan_upgrade() == ["12.10.14-ce.0", "13.0.14-ce.0"]
+
+    # Never downgrade
+    libgitlab.charm_config["version"] = "12.0.0-ce.0"
+    assert libgitlab.plan_upgrade() == []
+
+
+def test_get_available_versions(libgitlab, mock_gitlab_subprocess):
+    """Test get_available_versions parses and sorts apt-cache madison output."""
+    mock_gitlab_subprocess.check_output.return_value = (
+        " gitlab-ce | 13.0.14-ce.0 | https://packages.gitlab.com/gitlab/gitlab-ce/ubuntu bionic/main amd64 Packages\n"
+        " gitlab-ce | 12.10.14-ce.0 | https://packages.gitlab.com/gitlab/gitlab-ce/ubuntu bionic/main amd64 Packages\n"
+        " gitlab-ce | 13.0.14-ce.0 | /var/lib/dpkg/status\n"
+    )
+    result = type(libgitlab).get_available_versions(libgitlab)
+    assert result == ["12.10.14-ce.0", "13.0.14-ce.0"]
+
+
+def test_report_upgrade_plan(libgitlab, mock_action_set):
+    """Test the upgrade plan is reported with an estimated duration."""
+    libgitlab.get_installed_version.return_value = "1.0.0"
+    libgitlab.get_available_versions.return_value = ["1.0.0", "1.1.0", "1.1.1"]
+    plan = libgitlab.report_upgrade_plan()
+    assert plan == ["1.1.1"]
+    assert mock_action_set.call_args == call(
+        {"plan": "1.1.1", "steps": 1, "estimated-duration": "600s"}
+    )
+    assert libgitlab.gitlab_reconfigure_run.call_count == 0
+
+    libgitlab.record_upgrade_step(100)
+    libgitlab.record_upgrade_step(200)
+    assert libgitlab.estimate_upgrade_duration(["1.1.1", "2.0.0"]) == 300
+
+
+def test_upgrade_gitlab_package_metadata_cache(libgitlab, monkeypatch):
+    """Test cached package metadata skips the APT index until it expires or is invalidated."""
+    now = 1000000.0
+    monkeypatch.setattr("libgitlab.time.time", lambda: now)
+    assert libgitlab.upgrade_gitlab() is False
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 1
+    assert libgitlab.kv.get("package_metadata")["installed"] == "1.1.1"
+
+    # Unrelated hooks don't touch APT while the cache is fresh
+    assert libgitlab.upgrade_gitlab() is False
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 1
+
+    # The upgrade action always refreshes
+    assert libgitlab.upgrade_gitlab(refresh=True) is False
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 2
+
+    # Changing the package source invalidates the cache
+    libgitlab.charm_config["apt_repo"] = "https://mirror.example.com/gitlab"
+    libgitlab.upgrade_gitlab()
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 3
+    libgitlab.upgrade_gitlab()
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 3
+
+    # Expired metadata is refreshed
+    now += libgitlab.charm_config["package_cache_ttl"] + 1
+    libgitlab.upgrade_gitlab()
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 4
+
+    # A configured version which isn't installed always goes to APT, and upgrading clears the cache
+    libgitlab.charm_config["version"] = "1.2.0"
+    libgitlab.get_latest_version.return_value = "1.2.0"
+    assert libgitlab.upgrade_gitlab() is True
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 5
+    assert libgitlab.kv.get("package_metadata") is None
+
+    # A TTL of 0 disables caching
+    libgitlab.charm_config["package_cache_ttl"] = 0
+    libgitlab.upgrade_gitlab()
+    libgitlab.upgrade_gitlab()
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 7
+
+
+def test_prefetch_upgrade(libgitlab, tmpdir, mock_gitlab_subprocess, mock_action_set):
+    """Test every planned package is downloaded and verified ahead of the upgrade."""
+    import hashlib
+
+    libgitlab.package_cache_dir = tmpdir.mkdir("packages").strpath
+    libgitlab.get_installed_version.return_value = "0.0.0"
+    libgitlab.get_available_versions.return_value = ["0.0.0", "0.2.1", "1.1.1"]
+    digests = {}
+    for version in ("0.2.1", "1.1.1"):
+        digests[version] = hashlib.sha256(version.encode()).hexdigest()
+
+    def mock_show(cmd, **kwargs):
+        return "Package: gitlab-ce\nSHA256: {}\n".format(digests[cmd[-1].split("=")[1]])
+
+    def mock_download(cmd, cwd):
+        version = cmd[-1].split("=")[1]
+        with open("{}/gitlab-ce_{}_amd64.deb".format(cwd, version), "w") as deb:
+            deb.write(version)
+
+    mock_gitlab_subprocess.check_output.side_effect = mock_show
+    mock_gitlab_subprocess.check_call.side_effect = mock_download
+    assert libgitlab.prefetch_upgrade(concurrency=2) == ["0.2.1", "1.1.1"]
+    assert mock_gitlab_subprocess.check_call.call_count == 2
+    assert libgitlab.kv.get("prefetched_packages") == digests
+    assert mock_action_set.call_args[0][0]["packages"] == "0.2.1 1.1.1"
+    assert libgitlab.get_cached_package("1.1.1").endswith("gitlab-ce_1.1.1_amd64.deb")
+
+    # Already staged packages are not downloaded again
+    mock_gitlab_subprocess.check_call.reset_mock()
+    libgitlab.prefetch_upgrade()
+    assert mock_gitlab_subprocess.check_call.call_count == 0
+
+    # A corrupt package is discarded rather than installed
+    with open(libgitlab.get_cached_package_path("0.2.1"), "w") as deb:
+        deb.write("corrupt")
+    assert libgitlab.get_cached_package("0.2.1") is None
+    assert libgitlab.get_cached_package_path("0.2.1") is None
+    assert "0.2.1" not in libgitlab.kv.get("prefetched_packages")
+
+
+def test_prefetch_upgrade_checksum_mismatch(libgitlab, tmpdir, mock_gitlab_subprocess):
+    """Test a download which does not match the APT index checksum is rejected."""
+    libgitlab.package_cache_dir = tmpdir.mkdir("packages").strpath
+    libgitlab.get_installed_version.return_value = "1.0.0"
+    mock_gitlab_subprocess.check_output.return_value = "SHA256: 0000\n"
+
+    def mock_download(cmd, cwd):
+        with open("{}/gitlab-ce_1.1.1_amd64.deb".format(cwd), "w") as deb:
+            deb.write("1.1.1")
+
+    mock_gitlab_subprocess.check_call.side_effect = mock_download
+    with pytest.raises(ValueError):
+        libgitlab.prefetch_upgrade()
+    assert libgitlab.get_cached_package_path("1.1.1") is None
+
+
 def test_upgrade_gitlab_install(libgitlab, mock_gitlab_hookenv_log):
     """Test the upgrade path."""
     libgitlab.get_installed_version.return_value = ""
@@ -402,11 +1453,439 @@ def test_upgrade_gitlab_install(libgitlab, mock_gitlab_hookenv_log):
     assert result is True
 
 
-def test_backup(libgitlab, mock_gitlab_subprocess, mock_layers):
+BACKUP_OUTPUT = """\
+2024-02-22 16:58:17 UTC -- Dumping database ...
+Dumping PostgreSQL database gitlabhq_production ... [DONE]
+2024-02-22 16:58:20 UTC -- Dumping database ... done
+2024-02-22 16:58:20 UTC -- Dumping repositories ...
+2024-02-22 17:10:05 UTC -- Dumping repositories ... done
+2024-02-22 17:10:05 UTC -- Dumping artifacts ...
+2024-02-22 17:10:05 UTC -- Dumping artifacts ... [SKIPPED]
+2024-02-22 17:10:05 UTC -- Dumping lfs objects ...
+2024-02-22 17:10:07 UTC -- Dumping lfs objects ... done
+2024-02-22 17:10:07 UTC -- Dumping container registry images ... [DISABLED]
+2024-02-22 17:10:09 UTC -- Backup 1708621809_2024_02_22_16.9.0 is done.
+"""
+
+
+def test_backup(libgitlab, mock_gitlab_subprocess, mock_layers, mock_action_set):
     """Test backup."""
+    mock_gitlab_subprocess.check_output.return_value = BACKUP_OUTPUT
     libgitlab.backup()
     assert mock_gitlab_subprocess.check_output.call_count == 1
     assert mock_layers["layer_backup"].call_count == 1
+    result = mock_action_set.call_args[0][0]
+    assert result["backup-id"] == "1708621809_2024_02_22_16.9.0"
+    assert result["incremental"] is False
+    assert result["components.database"] == "3s"
+    assert result["components.repositories"] == "705s"
+    assert result["components.artifacts"] == "skipped"
+    assert result["components.lfs-objects"] == "2s"
+    assert result["components.container-registry-images"] == "skipped"
+    stats = {stat["operation"]: stat for stat in libgitlab.get_hook_profile()}
+    assert stats["backup repositories"]["max"] == 705
+
+
+def test_backup_stream(libgitlab, mock_gitlab_subprocess, mock_layers, mock_action_set, mock_apt_install, tmpdir):
+    """Test backups are streamed through a parallel compressor to their destination."""
+    from libgitlab import BACKUP_STREAM_CHUNK
+
+    mock_gitlab_subprocess.check_output.return_value = BACKUP_OUTPUT
+    tmpdir = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = tmpdir.strpath
+    libgitlab.charm_config["backup_skip"] = "registry"
+    libgitlab.charm_config["backup_stream_command"] = "aws s3 cp - s3://backups/{name}"
+    tmpdir.mkdir("repositories").join("project.bundle").write("bundle")
+    tmpdir.join("backup_information.yml").write("")
+    tmpdir.join("1708000000_2024_02_15_16.9.0_gitlab_backup.tar").write("")
+    tmpdir.join("restore-notes.txt").write("")
+
+    tar, compress, destination = mock.Mock(), mock.Mock(), mock.Mock()
+    compress.stdout = io.BytesIO(b"x" * (BACKUP_STREAM_CHUNK + 10))
+    destination.stdin = io.BytesIO()
+    destination.stdin.close = mock.Mock()
+    for process in tar, compress, destination:
+        process.wait.return_value = 0
+    mock_gitlab_subprocess.Popen.side_effect = [tar, compress, destination]
+    libgitlab.backup()
+
+    cmd = mock_gitlab_subprocess.check_output.call_args[0][0]
+    assert cmd[-1] == "SKIP=registry,tar"
+    popens = [popen[0][0] for popen in mock_gitlab_subprocess.Popen.call_args_list]
+    assert popens == [
+        ["tar", "-C", tmpdir.strpath, "-cf", "-", "backup_information.yml", "repositories"],
+        ["zstd", "-T0", "-c"],
+        ["aws", "s3", "cp", "-", "s3://backups/1708621809_2024_02_22_16.9.0_gitlab_backup.tar.zst"],
+    ]
+    assert mock_apt_install.call_args == call("zstd", fatal=True)
+    assert len(destination.stdin.getvalue()) == BACKUP_STREAM_CHUNK + 10
+    result = mock_action_set.call_args[0][0]
+    assert result["stream.bytes"] == BACKUP_STREAM_CHUNK + 10
+    assert "stream.throughput" in result
+    assert sorted(tmpdir.listdir()) == [
+        tmpdir.join("1708000000_2024_02_15_16.9.0_gitlab_backup.tar"),
+        tmpdir.join("restore-notes.txt"),
+    ]
+
+
+def test_backup_stream_failure(libgitlab, mock_gitlab_subprocess, mock_apt_install, tmpdir):
+    """Test a failing destination fails the backup and keeps the unarchived backup."""
+    tmpdir = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = tmpdir.strpath
+    libgitlab.charm_config["backup_stream_command"] = "false"
+    libgitlab.charm_config["backup_stream_compression"] = "pigz"
+    staging = tmpdir.mkdir("1708621809_2024_02_22_16.9.0")
+    staging.join("backup_information.yml").write("")
+
+    tar, compress, destination = mock.Mock(), mock.Mock(), mock.Mock()
+    compress.stdout = io.BytesIO(b"x")
+    tar.wait.return_value = compress.wait.return_value = 0
+    destination.wait.return_value = 1
+    for process in tar, compress, destination:
+        process.poll.return_value = 0
+    mock_gitlab_subprocess.Popen.side_effect = [tar, compress, destination]
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    with pytest.raises(subprocess.CalledProcessError):
+        libgitlab.stream_backup("1708621809_2024_02_22_16.9.0")
+    assert mock_gitlab_subprocess.Popen.call_args_list[1][0][0] == ["pigz", "-c"]
+    assert staging.join("backup_information.yml").exists()
+
+    # a destination which goes away mid stream stops the processes feeding it
+    tar, compress, destination = mock.Mock(), mock.Mock(), mock.Mock()
+    compress.stdout = io.BytesIO(b"x")
+    destination.stdin.write.side_effect = BrokenPipeError
+    tar.poll.return_value = compress.poll.return_value = None
+    destination.poll.return_value = 1
+    mock_gitlab_subprocess.Popen.side_effect = [tar, compress, destination]
+    with pytest.raises(BrokenPipeError):
+        libgitlab.stream_backup("1708621809_2024_02_22_16.9.0")
+    assert tar.kill.call_count == compress.kill.call_count == 1
+    assert destination.kill.call_count == 0
+    assert staging.join("backup_information.yml").exists()
+
+
+def test_backup_stream_empty(libgitlab, mock_gitlab_subprocess, mock_apt_install, tmpdir):
+    """Test streaming a backup which left nothing unarchived fails before running tar."""
+    tmpdir = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = tmpdir.strpath
+    libgitlab.charm_config["backup_stream_command"] = "aws s3 cp - s3://backups/{name}"
+    tmpdir.mkdir("1708621809_2024_02_22_16.9.0")
+    with pytest.raises(ValueError, match="left nothing to stream"):
+        libgitlab.stream_backup("1708621809_2024_02_22_16.9.0")
+    with pytest.raises(ValueError, match="left nothing to stream"):
+        libgitlab.stream_backup("1708621810_2024_02_22_16.9.0")
+    assert mock_gitlab_subprocess.Popen.call_count == 0
+
+
+RESTORE_OUTPUT = """\
+2024-02-22 18:00:00 UTC -- Restoring database ...
+2024-02-22 18:02:00 UTC -- Restoring database ... done
+2024-02-22 18:02:00 UTC -- Restoring repositories ...
+2024-02-22 18:12:00 UTC -- Restoring repositories ... done
+2024-02-22 18:12:00 UTC -- Restoring artifacts ... [SKIPPED]
+"""
+
+
+def test_restore(libgitlab, mock_gitlab_subprocess, mock_action_set, mock_juju_model, tmpdir):
+    """Test restore of the latest backup with its secrets."""
+    mock_gitlab_subprocess.check_output.side_effect = lambda cmd, **kwargs: (
+        "16.9.0-ce.0" if cmd[0] == "dpkg-query" else RESTORE_OUTPUT
+    )
+    backups = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = backups.strpath
+    backups.join("1708000000_2024_02_15_16.9.0_gitlab_backup.tar").write("")
+    backups.join("1708621809_2024_02_22_16.9.0_gitlab_backup.tar").write("")
+    secrets = tmpdir.join("restored-secrets.json")
+    secrets.write('{"gitlab_rails": {}}')
+    libgitlab.charm_config["backup_max_concurrency"] = 8
+    libgitlab.render_config = mock.Mock()
+    libgitlab.gitlab_reconfigure_run = mock.Mock()
+    libgitlab.restore(secrets=secrets.strpath, storage_concurrency=2)
+
+    calls = [call[0][0] for call in mock_gitlab_subprocess.check_call.call_args_list]
+    assert calls == [
+        ["/usr/bin/gitlab-ctl", "stop", "puma"],
+        ["/usr/bin/gitlab-ctl", "stop", "sidekiq"],
+        ["/usr/bin/gitlab-ctl", "restart"],
+    ]
+    assert mock_gitlab_subprocess.check_output.call_args[0][0] == [
+        "sudo",
+        "gitlab-backup",
+        "restore",
+        "BACKUP=1708621809_2024_02_22_16.9.0",
+        "force=yes",
+        "GITLAB_BACKUP_MAX_CONCURRENCY=8",
+        "GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY=2",
+    ]
+    with open(libgitlab.gitlab_secrets) as secrets_file:
+        assert secrets_file.read() == '{"gitlab_rails": {}}'
+    assert mock_juju_model["leader_settings"]["gitlab-secrets"] == '{"gitlab_rails": {}}'
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+    result = mock_action_set.call_args[0][0]
+    assert result["backup-id"] == "1708621809_2024_02_22_16.9.0"
+    assert list(key for key in result if key.startswith("phases.")) == [
+        "phases.preflight",
+        "phases.stop",
+        "phases.secrets",
+        "phases.restore",
+        "phases.reconfigure",
+        "phases.start",
+    ]
+    assert libgitlab.fetch_gitlab_apt_package.call_count == 0
+    assert mock_gitlab_subprocess.check_output.call_args_list[0][0][0] == [
+        "dpkg-query",
+        "-W",
+        "-f=${Version}",
+        "gitlab-ce",
+    ]
+    assert result["components.database"] == "120s"
+    assert result["components.repositories"] == "600s"
+    assert "components.artifacts" not in result
+
+
+def test_restore_preflight(libgitlab, mock_gitlab_subprocess, tmpdir):
+    """Test restore stops before touching any service if the backup can't be restored."""
+    libgitlab.backup_dir = tmpdir.mkdir("backups").strpath
+    with pytest.raises(ValueError, match="No backup archive"):
+        libgitlab.restore()
+    with pytest.raises(ValueError, match="not found"):
+        libgitlab.restore("1708621809_2024_02_22_16.9.0")
+    tmpdir.join("backups", "1708621809_2024_02_22_16.9.0_gitlab_backup.tar").write("")
+    mock_gitlab_subprocess.CalledProcessError = subprocess.CalledProcessError
+    mock_gitlab_subprocess.check_output.side_effect = subprocess.CalledProcessError(1, "dpkg-query")
+    with pytest.raises(ValueError, match="GitLab is not installed"):
+        libgitlab.restore("1708621809_2024_02_22_16.9.0")
+    mock_gitlab_subprocess.check_output.side_effect = None
+    mock_gitlab_subprocess.check_output.return_value = "16.10.1-ce.0"
+    with pytest.raises(ValueError, match="made by GitLab 16.9.0, but GitLab 16.10.1"):
+        libgitlab.restore("1708621809_2024_02_22_16.9.0")
+    assert mock_gitlab_subprocess.check_call.call_count == 0
+
+
+def _bundle(pack_data, object_format="sha1"):
+    """Return the bytes of a git bundle with a packfile holding pack_data."""
+    pack = b"PACK" + pack_data
+    header = b"# v2 git bundle\n" + b"a" * 40 + b" refs/heads/main\n\n"
+    if object_format == "sha256":
+        header = b"# v3 git bundle\n@object-format=sha256\n" + b"a" * 64 + b" refs/heads/main\n\n"
+    return header + pack + hashlib.new(object_format, pack).digest()
+
+
+def _add_member(archive, name, data):
+    """Add a file with the given bytes to a tar archive."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    archive.addfile(info, io.BytesIO(data))
+
+
+def test_verify_bundle():
+    """Test git bundles are checked against their packfile checksum."""
+    from libgitlab import verify_bundle
+
+    assert verify_bundle(io.BytesIO(_bundle(b"objects")))
+    assert verify_bundle(io.BytesIO(_bundle(b"o" * 3 * 1024 * 1024)))
+    assert verify_bundle(io.BytesIO(_bundle(b"objects", "sha256")))
+    assert not verify_bundle(io.BytesIO(_bundle(b"objects").replace(b"objects", b"0bjects")))
+    assert not verify_bundle(io.BytesIO(_bundle(b"objects")[:-1]))
+    assert not verify_bundle(io.BytesIO(b"not a bundle\n\nPACK"))
+    assert not verify_bundle(io.BytesIO(b""))
+
+
+def test_verify_backup(libgitlab, mock_action_set, monkeypatch, tmpdir):
+    """Test backup archives are verified as a stream."""
+    mock_action_fail = mock.Mock()
+    monkeypatch.setattr("libgitlab.hookenv.action_fail", mock_action_fail)
+    libgitlab.backup_dir = tmpdir.mkdir("backups").strpath
+    assert libgitlab.verify_backup() is False
+    assert mock_action_fail.call_args == call("No backup archive found in {}".format(libgitlab.backup_dir))
+    path = libgitlab.get_backup_path("1708621809_2024_02_22_16.9.0")
+    assert libgitlab.verify_backup("1708621809_2024_02_22_16.9.0") is False
+    assert mock_action_fail.call_args == call("Backup archive {} not found".format(path))
+    mock_action_fail.reset_mock()
+    with tarfile.open(path, "w") as archive:
+        _add_member(archive, "backup_information.yml", b":gitlab_version: 16.9.0\n")
+        _add_member(archive, "db/database.sql.gz", gzip.compress(b"CREATE TABLE projects;"))
+        _add_member(archive, "repositories/@hashed/ab/cd/abcd.bundle", _bundle(b"objects"))
+        _add_member(archive, "uploads.tar.gz", gzip.compress(b"uploads"))
+    assert libgitlab.verify_backup() is True
+    result = mock_action_set.call_args[0][0]
+    assert result["backup-id"] == "1708621809_2024_02_22_16.9.0"
+    assert (result["members"], result["bundles"], result["compressed"]) == (4, 1, 2)
+    assert result["failed"] == "none"
+    assert mock_action_fail.call_count == 0
+
+    with tarfile.open(path, "w") as archive:
+        _add_member(archive, "db/database.sql.gz", gzip.compress(b"CREATE TABLE projects;")[:-4] + b"0000")
+        _add_member(archive, "repositories/@hashed/ab/cd/abcd.bundle", _bundle(b"objects")[:-1] + b"0")
+        _add_member(archive, "repositories/@hashed/ef/01/ef01.bundle", _bundle(b"objects"))
+    assert libgitlab.verify_backup("1708621809_2024_02_22_16.9.0") is False
+    result = mock_action_set.call_args[0][0]
+    assert result["failed"] == "db/database.sql.gz\nrepositories/@hashed/ab/cd/abcd.bundle"
+    assert mock_action_fail.call_count == 1
+
+    with open(path, "r+b") as archive:
+        archive.truncate(600)
+    assert libgitlab.verify_backup() is False
+    assert "_gitlab_backup.tar" in mock_action_set.call_args[0][0]["failed"]
+
+
+def test_prune_backups(libgitlab, mock_gitlab_subprocess, mock_layers, mock_action_set, tmpdir):
+    """Test backups past retention are removed after each backup."""
+    now = int(time.time())
+    backups = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = backups.strpath
+    backup_ids = ["{}_backup_16.9.0".format(now - day * 86400 + 3600) for day in range(5)]
+    for backup_id in backup_ids:
+        backups.join("{}_gitlab_backup.tar".format(backup_id)).write("")
+    assert libgitlab.prune_backups() == []
+
+    libgitlab.charm_config["backup_keep_days"] = 3
+    assert libgitlab.prune_backups() == backup_ids[4:]
+    libgitlab.charm_config["backup_keep_count"] = 2
+    mock_gitlab_subprocess.check_output.return_value = BACKUP_OUTPUT
+    libgitlab.backup()
+    assert mock_action_set.call_args[0][0]["pruned"] == " ".join(backup_ids[2:4])
+    assert libgitlab.get_backup_ids() == backup_ids[:2]
+
+    # the most recent backup is always kept
+    backups.join("{}_gitlab_backup.tar".format(backup_ids[0])).remove()
+    libgitlab.charm_config["backup_keep_days"] = 1
+    libgitlab.charm_config["backup_keep_count"] = 1
+    assert libgitlab.prune_backups() == []
+    assert libgitlab.get_backup_ids() == backup_ids[1:2]
+
+
+def test_backup_ids_stray_archive(libgitlab, tmpdir):
+    """Test archives not named after a backup ID are skipped rather than breaking backup handling."""
+    backups = tmpdir.mkdir("backups")
+    libgitlab.backup_dir = backups.strpath
+    backups.join("old_gitlab_backup.tar").write("")
+    backups.join("1708621809_2024_02_22_16.9.0_gitlab_backup.tar").write("")
+    libgitlab.charm_config["backup_keep_count"] = 1
+    assert libgitlab.get_backup_ids() == ["1708621809_2024_02_22_16.9.0"]
+    assert libgitlab.get_latest_backup_id() == "1708621809_2024_02_22_16.9.0"
+    assert libgitlab.prune_backups() == []
+    assert backups.join("old_gitlab_backup.tar").exists()
+
+
+def test_backup_options(libgitlab, mock_gitlab_subprocess, mock_layers, mock_action_set, tmpdir):
+    """Test backup concurrency, skipped components and incremental backups."""
+    mock_gitlab_subprocess.check_output.return_value = BACKUP_OUTPUT
+    libgitlab.backup_dir = tmpdir.strpath
+    libgitlab.charm_config["backup_incremental"] = True
+    libgitlab.charm_config["backup_max_concurrency"] = 8
+    libgitlab.charm_config["backup_max_storage_concurrency"] = 2
+    libgitlab.charm_config["backup_skip"] = "artifacts, registry"
+    options = [
+        "GITLAB_BACKUP_MAX_CONCURRENCY=8",
+        "GITLAB_BACKUP_MAX_STORAGE_CONCURRENCY=2",
+        "SKIP=artifacts,registry",
+    ]
+
+    # without a previous backup, a full backup is made
+    libgitlab.backup()
+    cmd = mock_gitlab_subprocess.check_output.call_args[0][0]
+    assert cmd == ["sudo", "gitlab-backup", "create", "STRATEGY=copy"] + options
+
+    # the next one is incremental against the previous archive
+    tmpdir.join("1708621809_2024_02_22_16.9.0_gitlab_backup.tar").write("")
+    libgitlab.backup()
+    cmd = mock_gitlab_subprocess.check_output.call_args[0][0]
+    assert cmd[-2:] == ["INCREMENTAL=yes", "PREVIOUS_BACKUP=1708621809_2024_02_22_16.9.0"]
+    assert mock_action_set.call_args[0][0]["incremental"] is True
+
+
+def test_flush_reconfigure(libgitlab, mock_gitlab_hookenv_log):
+    """Test reconfigure requests are coalesced into a single run."""
+    assert libgitlab.flush_reconfigure() is False
+    libgitlab.request_reconfigure("gitlab.rb changed")
+    libgitlab.request_reconfigure("upgraded to 1.1.1")
+    assert libgitlab.gitlab_reconfigure_run.call_count == 0
+    assert libgitlab.flush_reconfigure() is True
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+    mock_gitlab_hookenv_log.assert_has_calls(
+        [
+            call(
+                "Running gitlab-ctl reconfigure for 2 request(s), skipped 1 run(s): "
+                "gitlab.rb changed, upgraded to 1.1.1"
+            )
+        ]
+    )
+    assert libgitlab.flush_reconfigure() is False
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+
+
+def test_configure_reconfigures_once(libgitlab, mock_gitlab_get_flag_value):
+    """Test a config change and a minor upgrade in one hook only reconfigure once."""
+    _configure_database("pgsql", libgitlab)
+    libgitlab.get_installed_version.return_value = "1.1.0"
+    assert libgitlab.configure() is True
+    assert libgitlab.reconfigure_requests == ["gitlab.rb changed", "upgraded to 1.1.1"]
+    libgitlab.flush_reconfigure()
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+
+
+def test_run_pgloader(libgitlab, mock_gitlab_subprocess):
+    """Test pgloader runs after a single reconfigure."""
+    _configure_database("pgsql", libgitlab)
+    mock_gitlab_subprocess.Popen.return_value.stdout = io.StringIO("")
+    mock_gitlab_subprocess.Popen.return_value.wait.return_value = 0
+    libgitlab.run_pgloader()
+    assert libgitlab.gitlab_reconfigure_run.call_count == 1
+    assert libgitlab.reconfigure_requests == []
+    assert mock_gitlab_subprocess.Popen.call_count == 1
+
+
+def test_parse_gitlab_rb():
+    """Test only effective settings are parsed from gitlab.rb."""
+    from libgitlab import parse_gitlab_rb
+
+    content = """## Reference comment
+external_url 'http://gitlab.example.com'
+
+gitlab_rails['db_password'] = "p{ss]"
+# gitlab_rails['db_pool'] = 10
+git_data_dirs({
+  # inline comment
+  "default" => { "path" => "/var/opt/gitlab/git-data" },
+})
+"""
+    settings = parse_gitlab_rb(content)
+    assert list(settings) == ["external_url", "gitlab_rails['db_password']", "git_data_dirs"]
+    assert settings["external_url"] == "'http://gitlab.example.com'"
+    assert settings["gitlab_rails['db_password']"] == '"p{ss]"'
+    reformatted = content.replace("## Reference comment", "## Edited comment").replace(
+        '"default" => {', '"default"   =>   {'
+    )
+    assert parse_gitlab_rb(reformatted) == settings
+
+
+def test_render_config_semantic_diff(libgitlab, mock_gitlab_hookenv_log):
+    """Test reconfigure is only requested when effective settings change."""
+    from libgitlab import parse_gitlab_rb
+
+    _rendered_config("pgsql", libgitlab)
+    assert libgitlab.reconfigure_requests == ["gitlab.rb changed"]
+    assert libgitlab.kv.get("gitlab_rb_settings")["gitlab_rails['db_host']"] == '"host"'
+    libgitlab.flush_reconfigure()
+
+    # Comment-only changes to the rendered file don't reconfigure
+    with open(libgitlab.gitlab_config, "r") as config_file:
+        content = config_file.read()
+    assert libgitlab.apply_settings(parse_gitlab_rb(content + "# a new reference comment\n")) is False
+    _rendered_config("pgsql", libgitlab)
+    assert libgitlab.reconfigure_requests == []
+    mock_gitlab_hookenv_log.assert_has_calls(
+        [call("No effective gitlab.rb setting changes, skipping reconfigure")]
+    )
+
+    # Effective changes do
+    libgitlab.charm_config["email_from"] = "gitlab@example.com"
+    _rendered_config("pgsql", libgitlab)
+    assert libgitlab.reconfigure_requests == ["gitlab.rb changed"]
+    mock_gitlab_hookenv_log.assert_has_calls(
+        [call("Changed gitlab.rb settings: gitlab_rails['gitlab_email_from']")]
+    )
 
 
 def test_render_config_fails_without_db(libgitlab, mock_gitlab_hookenv_log):
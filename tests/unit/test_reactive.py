@@ -0,0 +1,25 @@
+"""Test the reactive layer."""
+import ast
+import imp
+
+from charms.reactive.bus import Handler
+
+
+def test_handlers_registered(libgitlab, mock_charm_dir):
+    """Test every decorated handler is registered as a reactive handler of its own."""
+    with open("./reactive/layer_gitlab.py") as layer:
+        tree = ast.parse(layer.read())
+    handlers = [
+        node.name
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef)
+        and any(not isinstance(decorator, ast.Name) for decorator in node.decorator_list)
+    ]
+    Handler.clear()
+    try:
+        imp.load_source("layer_gitlab", "./reactive/layer_gitlab.py")
+        registered = Handler.get_handlers()
+        assert len(registered) == len(handlers)
+        assert sorted(handler.id().split(":")[-1] for handler in registered) == sorted(handlers)
+    finally:
+        Handler.clear()